@@ -6,20 +6,86 @@ if TYPE_CHECKING:
 import re
 from FunPayAPI.updater.events import NewOrderEvent, NewMessageEvent
 import logging
-from logging.handlers import RotatingFileHandler
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 from telebot import types
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
 from telebot.types import Message
 import os
 import json
 import time
+import copy
+import tempfile
 import random
 import asyncio
+import atexit
+import threading
+import queue
+import concurrent.futures
+import functools
+import bisect
+import contextlib
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pyrogram import Client
+from pyrogram.errors import FloodWait, UsernameNotOccupied, UsernameInvalid
 from pyrogram.errors.exceptions.bad_request_400 import StargiftUsageLimited
 from pyrogram.enums import ChatType
 from datetime import datetime, timedelta
 
+class JsonLineFormatter(logging.Formatter):
+    """One JSON object per record for log collectors"""
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+class LogPipeline:
+    """Records of the plugin logger go through a queue; the file handler writes them from a listener thread"""
+    def __init__(self, target: logging.Logger, handler: logging.Handler):
+        self.logger = target
+        self.handler = handler
+        self.text_formatter = handler.formatter
+        self.queue = queue.SimpleQueue()
+        # QueueHandler.prepare() подставляет аргументы в вызывающем потоке, поэтому в лог попадает снимок, а не живой объект
+        self.queue_handler = QueueHandler(self.queue)
+        self.listener = QueueListener(self.queue, handler, respect_handler_level=True)
+        self.lock = threading.Lock()
+        self.running = False
+
+    def start(self):
+        with self.lock:
+            if self.running:
+                return
+            self.listener.start()
+            self.logger.addHandler(self.queue_handler)
+            self.running = True
+
+    def stop(self):
+        """Drain the queue; records logged afterwards (atexit) are written directly"""
+        with self.lock:
+            if not self.running:
+                return
+            self.logger.removeHandler(self.queue_handler)
+            self.listener.stop()
+            self.logger.addHandler(self.handler)
+            self.running = False
+
+    def configure(self, level: str, as_json: bool):
+        """Apply the level of the plugin logger and the format of its log file"""
+        numeric = logging.getLevelName(str(level).upper())
+        if not isinstance(numeric, int):
+            self.logger.warning(f"{LOGGER_PREFIX} Unknown log_level {level!r}, using INFO")
+            numeric = logging.INFO
+        self.logger.setLevel(numeric)
+        self.handler.setFormatter(JsonLineFormatter() if as_json else self.text_formatter)
+
 logger = logging.getLogger("FPC.auto_gifts")
 logger.setLevel(logging.DEBUG)
 
@@ -30,9 +96,26 @@ file_handler = RotatingFileHandler(log_file, maxBytes=5*1024*1024, backupCount=3
 file_handler.setLevel(logging.DEBUG)
 formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 file_handler.setFormatter(formatter)
-logger.addHandler(file_handler)
+log_pipeline = LogPipeline(logger, file_handler)
+log_pipeline.start()
 
 LOGGER_PREFIX = "[AUTOGIFTS]"
+HEALTH_CHECK_INTERVAL = 300  # секунд между проверками пула клиентов
+BALANCE_TTL = 60  # секунд, сколько кэшированный баланс сессий считается свежим
+CATALOG_TTL = 300  # секунд, сколько кэшированный каталог подарков считается свежим
+CATALOG_MISS_COOLDOWN = 10  # секунд между внеплановыми обновлениями каталога при неизвестном gift_id
+LOTS_TTL = 300  # секунд, сколько кэшированное состояние наших лотов на FunPay считается свежим
+LOT_WIZARD_TIMEOUT = 600  # секунд бездействия, после которых добавление лота отменяется
+PANEL_FRESH_AGE = 15  # секунд; более старые балансы панель настроек обновляет в фоне
+METRICS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)  # секунд, границы корзин гистограммы задержек
+NOTIFY_DRAIN_TIMEOUT = 60  # секунд, сколько при остановке ждать отправки накопившихся уведомлений
+MAX_FLOOD_WAIT = 300  # секунд; более долгий FloodWait считается ошибкой сессии
+MAX_SEND_RETRIES = 3  # ошибок подряд при отправке одного подарка, после которых сессия отключается
+SEND_RETRY_BACKOFF = 1.0  # секунд паузы после первой ошибки отправки, дальше пауза удваивается
+USERNAME_CACHE_SIZE = 1000  # сколько разрешённых юзернеймов держать в памяти
+USERNAME_TTL = 3600  # секунд, сколько разрешённый юзернейм считается актуальным
+USERNAME_NEGATIVE_TTL = 60  # секунд, сколько помнить несуществующий юзернейм
+USERNAME_RE = re.compile(r'^[A-Za-z](?!\w*__)\w{2,30}[A-Za-z0-9]$', re.ASCII)
 SESSION_STATS_PATH = os.path.join("storage", "cache", "session_stats.json")
 NAME = "Auto Gifts"
 VERSION = "3.0.8"
@@ -49,8 +132,34 @@ waiting_for_lots_upload = set()
 auto_refunds = ""
 
 CONFIG_PATH = os.path.join("storage", "cache", "gift_lots.json")
-ORDERS_PATH = os.path.join("storage", "cache", "auto_gift_orders.json")
-SESSIONS_PATH = "/bot2/sessions"
+DEFAULT_SETTINGS = {
+    "auto_refunds": True,
+    "active_lots": True,
+    "probe_concurrency": 5,  # сколько сессий опрашивается одновременно
+    "probe_timeout": 15,  # секунд на опрос одной сессии
+    "split_orders": True,  # делить крупный заказ между несколькими сессиями
+    "send_rate": 1.0,  # начальный темп отправки подарков одной сессией, шт/с
+    "send_rate_min": 0.2,
+    "send_rate_max": 5.0,
+    "send_rate_step": 0.1,  # прибавка к темпу после каждой успешной отправки
+    "send_burst": 1,  # сколько подарков можно отправить подряд без паузы
+    "stats_flush_interval": 30,  # секунд между сохранениями статистики сессий
+    "lot_workers": 4,  # сколько лотов переключается параллельно
+    "lot_rate": 5.0,  # запросов к FunPay в секунду при массовом переключении лотов
+    "notify_rate": 1.0,  # сообщений в секунду одному администратору
+    "notify_coalesce_window": 60,  # секунд, в течение которых повторы одного уведомления сворачиваются в сводку
+    "metrics_interval": 30,  # секунд между записями файла метрик, 0 - не писать
+    "metrics_port": 0,  # порт локального HTTP-эндпоинта метрик, 0 - выключен
+    "log_level": "INFO",  # DEBUG, INFO, WARNING или ERROR
+    "log_json": False,  # писать auto_gifts.log строками JSON
+}
+ORDERS_PATH = os.path.join("storage", "cache", "auto_gift_orders.jsonl")
+LEGACY_ORDERS_PATH = os.path.join("storage", "cache", "auto_gift_orders.json")
+ORDER_STATE_PATH = os.path.join("storage", "cache", "auto_gift_pending_orders.json")
+ORDER_FULFILMENT_PATH = os.path.join("storage", "cache", "auto_gift_fulfilment.jsonl")
+METRICS_PATH = os.path.join("storage", "cache", "auto_gifts_metrics.prom")
+SESSIONS_PATH = os.environ.get("AUTO_GIFTS_SESSIONS_PATH", "/bot2/sessions")
+AUTHORIZED_USERS_PATH = os.path.join("storage", "cache", "tg_authorized_users.json")
 os.makedirs(os.path.dirname(ORDERS_PATH), exist_ok=True)
 os.makedirs(SESSIONS_PATH, exist_ok=True)
 
@@ -83,11 +192,290 @@ EMOJI_SETS = [
 ]
 
 SESSION_STATS_PATH = os.path.join("storage", "cache", "session_stats.json")
+SESSION_STATS_JOURNAL_PATH = os.path.join("storage", "cache", "session_stats.journal")
+
+class AsyncRunner:
+    """Single event loop living in a background thread; every plugin coroutine runs on it"""
+    def __init__(self):
+        self.loop = None
+        self.thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self.loop is not None and self.loop.is_running()
+
+    def start(self):
+        with self._lock:
+            if self.running:
+                return
+            loop = asyncio.new_event_loop()
+            started = threading.Event()
+
+            def run_loop():
+                asyncio.set_event_loop(loop)
+                loop.call_soon(started.set)
+                loop.run_forever()
+
+            self.loop = loop
+            self.thread = threading.Thread(target=run_loop, name="auto-gifts-loop", daemon=True)
+            self.thread.start()
+            started.wait()
+            logger.info("%s Background event loop started", LOGGER_PREFIX)
+
+    def submit(self, coro) -> concurrent.futures.Future:
+        """Schedule a coroutine on the background loop from any thread"""
+        self.start()
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def submit_callback(self, callback, *args):
+        """Run a plain callback on the background loop from any thread"""
+        self.start()
+        self.loop.call_soon_threadsafe(callback, *args)
+
+    def run(self, coro, timeout=None):
+        """Run a coroutine on the background loop and wait for its result (sync callers only)"""
+        if threading.current_thread() is self.thread:
+            coro.close()
+            raise RuntimeError("AsyncRunner.run() called from the event loop thread")
+        return self.submit(coro).result(timeout)
+
+    async def _cancel_tasks(self):
+        tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stop(self):
+        with self._lock:
+            if not self.running:
+                return
+            try:
+                asyncio.run_coroutine_threadsafe(self._cancel_tasks(), self.loop).result(10)
+            except Exception as e:
+                logger.warning(f"{LOGGER_PREFIX} Error cancelling background tasks: {str(e)}")
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join(timeout=10)
+            self.loop.close()
+            self.loop = None
+            self.thread = None
+            logger.info("%s Background event loop stopped", LOGGER_PREFIX)
+
+runner = AsyncRunner()
+
+async def to_thread(func, *args, **kwargs):
+    """Run a blocking call (telebot, FunPay) in the default executor"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+def atomic_write_json(path: str, data, indent=4):
+    """Write JSON into a temp file next to path and rename it over the target"""
+    atomic_write_text(path, json.dumps(data, ensure_ascii=False, indent=indent))
+
+def atomic_write_text(path: str, text: str):
+    """Write text into a temp file next to path and rename it over the target"""
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{os.path.basename(path)}.", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+class Metrics:
+    """Latency histograms and error counters per call, session and gift/lot in the Prometheus text format"""
+    def __init__(self, buckets=METRICS_BUCKETS):
+        self.lock = threading.Lock()
+        self.buckets = tuple(buckets)
+        self.latency: Dict[Tuple, List] = {}  # метки -> [счётчики по корзинам (+Inf последней), сумма секунд]
+        self.errors: Dict[Tuple, int] = {}
+        self.dirty = False
+        self.server = None
+
+    def observe(self, call: str, seconds: float, error: str | None = None, **labels):
+        key = (("call", call),) + tuple((k, str(v)) for k, v in sorted(labels.items()) if v is not None)
+        with self.lock:
+            entry = self.latency.get(key)
+            if entry is None:
+                entry = self.latency[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][bisect.bisect_left(self.buckets, seconds)] += 1
+            entry[1] += seconds
+            self.dirty = True
+            if error is not None:
+                error_key = key + (("error", error),)
+                self.errors[error_key] = self.errors.get(error_key, 0) + 1
+
+    @contextlib.contextmanager
+    def timer(self, call: str, **labels):
+        """Time the with-block; an exception leaving it is counted as an error of the call"""
+        started = time.perf_counter()
+        error = None
+        try:
+            yield
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            self.observe(call, time.perf_counter() - started, error, **labels)
+
+    def timed(self, call: str):
+        """timer() as a decorator for plain and async functions"""
+        def decorator(func):
+            if asyncio.iscoroutinefunction(func):
+                @functools.wraps(func)
+                async def wrapper(*args, **kwargs):
+                    with self.timer(call):
+                        return await func(*args, **kwargs)
+            else:
+                @functools.wraps(func)
+                def wrapper(*args, **kwargs):
+                    with self.timer(call):
+                        return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    @staticmethod
+    def _format_labels(key: Tuple) -> str:
+        return ",".join(
+            '{}="{}"'.format(name, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+            for name, value in key
+        )
+
+    def render(self) -> str:
+        with self.lock:
+            latency = sorted((key, list(counts), total) for key, (counts, total) in self.latency.items())
+            errors = sorted(self.errors.items())
+        lines = [
+            "# HELP auto_gifts_call_duration_seconds Latency of Telegram and FunPay calls made by the plugin",
+            "# TYPE auto_gifts_call_duration_seconds histogram",
+        ]
+        for key, counts, total in latency:
+            labels = self._format_labels(key)
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                lines.append(f'auto_gifts_call_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f"auto_gifts_call_duration_seconds_sum{{{labels}}} {total:.6f}")
+            lines.append(f"auto_gifts_call_duration_seconds_count{{{labels}}} {cumulative}")
+        lines += [
+            "# HELP auto_gifts_call_errors_total Calls that ended with an exception, by exception type",
+            "# TYPE auto_gifts_call_errors_total counter",
+        ]
+        for key, count in errors:
+            lines.append(f"auto_gifts_call_errors_total{{{self._format_labels(key)}}} {count}")
+        return "\n".join(lines) + "\n"
+
+    def write(self):
+        """Rewrite the metrics file if anything was observed since the last write"""
+        with self.lock:
+            if not self.dirty:
+                return
+            self.dirty = False
+        atomic_write_text(METRICS_PATH, self.render())
+
+    async def write_loop(self):
+        while True:
+            await asyncio.sleep(get_setting("metrics_interval"))
+            try:
+                await to_thread(self.write)
+            except Exception as e:
+                logger.error(f"{LOGGER_PREFIX} Metrics write error: {str(e)}")
+
+    def serve(self, port: int):
+        """Answer GET /metrics on 127.0.0.1:port from a daemon thread"""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name="auto-gifts-metrics", daemon=True).start()
+        logger.info("%s Metrics endpoint listening on http://127.0.0.1:%s/metrics", LOGGER_PREFIX, port)
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+metrics = Metrics()
+
+class SendRateLimiter:
+    """Token bucket for one session: speeds up on success, halves the rate and waits out FloodWait"""
+    def __init__(self, rate: float, min_rate: float, max_rate: float, step: float, burst: int):
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.step = step
+        self.burst = max(burst, 1)
+        self.rate = min(max(rate, min_rate), max_rate)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def on_success(self):
+        self.rate = min(self.max_rate, self.rate + self.step)
+
+    def on_flood_wait(self, seconds: float):
+        self.blocked_until = time.monotonic() + seconds
+        self.rate = max(self.min_rate, self.rate / 2)
+        self.tokens = 0.0
+        logger.warning(f"{LOGGER_PREFIX} FloodWait {seconds}s, send rate lowered to {self.rate:.2f}/s")
+
+    def on_error(self, seconds: float):
+        """Back off after a failed send that was not a FloodWait"""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.rate = max(self.min_rate, self.rate / 2)
+        self.tokens = 0.0
 
 class SessionManager:
     def __init__(self):
         self.sessions = []
         self.current_session_index = 0
+        self.clients: Dict[str, Client] = {}
+        self.client_locks: Dict[str, asyncio.Lock] = {}
+        self.balances_updated = None
+        self.refresh_task = None
+        self.limiters: Dict[str, SendRateLimiter] = {}
+        self.stats_lock = threading.Lock()
+        self.stats_seq = 0
+        self.stats_dirty = False
+        self.stats_journal = None
         self.load_sessions()
         self.load_session_stats()
 
@@ -102,184 +490,807 @@ class SessionManager:
                 "active": True,
                 "last_used": datetime.min,  # Инициализация last_used
                 "balance": None,
+                "balance_updated": None,
                 "gifts_sent": 0,
                 "total_cost": 0.0
             })
-        logger.info(f"{LOGGER_PREFIX} Loaded {len(self.sessions)} sessions")
+        logger.info("%s Loaded %s sessions", LOGGER_PREFIX, len(self.sessions))
 
     def load_session_stats(self):
-        """Load session statistics (gifts sent and total cost)"""
+        """Load session statistics (gifts sent and total cost) and replay the journal on top"""
+        by_name = {session["name"]: session for session in self.sessions}
         if os.path.exists(SESSION_STATS_PATH):
             with open(SESSION_STATS_PATH, 'r', encoding='utf-8') as f:
                 stats = json.load(f)
-            for session in self.sessions:
-                session_name = session["name"]
-                if session_name in stats:
-                    session["gifts_sent"] = stats[session_name].get("gifts_sent", 0)
-                    session["total_cost"] = stats[session_name].get("total_cost", 0.0)
-            logger.info(f"{LOGGER_PREFIX} Loaded session stats from {SESSION_STATS_PATH}")
+            self.stats_seq = stats.pop("__journal_seq__", 0)
+            for session_name, session_stats in stats.items():
+                if session_name in by_name:
+                    by_name[session_name]["gifts_sent"] = session_stats.get("gifts_sent", 0)
+                    by_name[session_name]["total_cost"] = session_stats.get("total_cost", 0.0)
+            logger.info("%s Loaded session stats from %s", LOGGER_PREFIX, SESSION_STATS_PATH)
         else:
-            logger.info(f"{LOGGER_PREFIX} No session stats found, initializing empty stats")
-            self.save_session_stats()
+            logger.info("%s No session stats found, initializing empty stats", LOGGER_PREFIX)
+
+        replayed = 0
+        if os.path.exists(SESSION_STATS_JOURNAL_PATH):
+            with open(SESSION_STATS_JOURNAL_PATH, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    if entry["seq"] <= self.stats_seq or entry["name"] not in by_name:
+                        continue
+                    by_name[entry["name"]]["gifts_sent"] += 1
+                    by_name[entry["name"]]["total_cost"] += entry["cost"]
+                    self.stats_seq = entry["seq"]
+                    replayed += 1
+        if replayed:
+            logger.info("%s Recovered %s gifts from the session stats journal", LOGGER_PREFIX, replayed)
+        self.stats_dirty = True
+        self.save_session_stats()
+
+    def record_gift(self, session, cost):
+        """Count a sent gift in memory and in the append journal; the snapshot is written later"""
+        with self.stats_lock:
+            session["gifts_sent"] += 1
+            session["total_cost"] += cost
+            self.stats_seq += 1
+            if self.stats_journal is None:
+                os.makedirs(os.path.dirname(SESSION_STATS_JOURNAL_PATH), exist_ok=True)
+                self.stats_journal = open(SESSION_STATS_JOURNAL_PATH, 'a', encoding='utf-8')
+            self.stats_journal.write(json.dumps({"seq": self.stats_seq, "name": session["name"], "cost": cost}) + "\n")
+            self.stats_journal.flush()
+            self.stats_dirty = True
 
     def save_session_stats(self):
-        """Save session statistics to file"""
-        stats = {}
+        """Write the stats snapshot (if anything changed) and truncate the journal"""
+        with self.stats_lock:
+            if not self.stats_dirty:
+                return
+            stats = {}
+            for session in self.sessions:
+                stats[session["name"]] = {
+                    "gifts_sent": session["gifts_sent"],
+                    "total_cost": session["total_cost"]
+                }
+            stats["__journal_seq__"] = self.stats_seq
+            atomic_write_json(SESSION_STATS_PATH, stats)
+            if self.stats_journal is not None:
+                self.stats_journal.close()
+            # Записи с seq <= __journal_seq__ уже в снимке и при падении до этой строки будут пропущены
+            self.stats_journal = open(SESSION_STATS_JOURNAL_PATH, 'w', encoding='utf-8')
+            self.stats_dirty = False
+        logger.debug("%s Saved session stats to %s", LOGGER_PREFIX, SESSION_STATS_PATH)
+
+    async def stats_flush_loop(self):
+        while True:
+            await asyncio.sleep(get_setting("stats_flush_interval"))
+            try:
+                await to_thread(self.save_session_stats)
+            except Exception as e:
+                logger.error(f"{LOGGER_PREFIX} Session stats flush error: {str(e)}")
+
+    async def get_client(self, session) -> Client:
+        """Borrow a started client for the session, (re)connecting it if needed"""
+        name = session["name"]
+        lock = self.client_locks.setdefault(name, asyncio.Lock())
+        async with lock:
+            app = self.clients.get(name)
+            if app is not None and not app.is_connected:
+                logger.warning(f"{LOGGER_PREFIX} Client for session {name} is disconnected, reconnecting")
+                await self._stop_client(name, app)
+                app = None
+            if app is None:
+                app = Client(name, workdir=SESSIONS_PATH)
+                try:
+                    await app.start()
+                except BaseException:
+                    # Отменённый по таймауту опроса start() оставляет открытое соединение и занятый .session файл
+                    await self._abort_client(name, app)
+                    raise
+                self.clients[name] = app
+                logger.info("%s Client for session %s started", LOGGER_PREFIX, name)
+            return app
+
+    async def drop_client(self, session):
+        """Stop and forget the pooled client, the next borrow will reconnect"""
+        name = session["name"]
+        app = self.clients.pop(name, None)
+        if app is not None:
+            await self._stop_client(name, app)
+
+    async def _stop_client(self, name, app):
+        self.clients.pop(name, None)
+        try:
+            if app.is_connected:
+                await app.stop()
+        except Exception as e:
+            logger.warning(f"{LOGGER_PREFIX} Error stopping client for session {name}: {str(e)}")
+
+    async def _abort_client(self, name, app):
+        """Release whatever a failed or cancelled start() left open"""
+        if app.is_connected:
+            await self._stop_client(name, app)
+            return
+        # connect() прервался до is_connected: stop() такой клиент не закроет, закрываем сессию и хранилище сами
+        try:
+            if getattr(app, "session", None) is not None:
+                await app.session.stop()
+            if getattr(app, "storage", None) is not None:
+                await app.storage.close()
+        except Exception as e:
+            logger.warning(f"{LOGGER_PREFIX} Error releasing half-started client for session {name}: {str(e)}")
+
+    async def health_check(self):
+        """Ping every pooled client and drop the ones that do not answer"""
         for session in self.sessions:
-            stats[session["name"]] = {
-                "gifts_sent": session["gifts_sent"],
-                "total_cost": session["total_cost"]
-            }
-        os.makedirs(os.path.dirname(SESSION_STATS_PATH), exist_ok=True)
-        with open(SESSION_STATS_PATH, 'w', encoding='utf-8') as f:
-            json.dump(stats, f, ensure_ascii=False, indent=4)
-        logger.info(f"{LOGGER_PREFIX} Saved session stats to {SESSION_STATS_PATH}")
+            if session["name"] not in self.clients:
+                continue
+            try:
+                app = await self.get_client(session)
+                await app.get_me()
+            except Exception as e:
+                logger.warning(f"{LOGGER_PREFIX} Health check failed for session {session['name']}: {str(e)}")
+                await self.drop_client(session)
+
+    async def health_check_loop(self):
+        while True:
+            await asyncio.sleep(HEALTH_CHECK_INTERVAL)
+            try:
+                await self.health_check()
+            except Exception as e:
+                logger.error(f"{LOGGER_PREFIX} Health check loop error: {str(e)}")
+
+    async def close_clients(self):
+        """Stop all pooled clients"""
+        for name, app in list(self.clients.items()):
+            await self._stop_client(name, app)
+        logger.info("%s All pooled clients stopped", LOGGER_PREFIX)
+
+    def limiter(self, session) -> SendRateLimiter:
+        name = session["name"]
+        if name not in self.limiters:
+            self.limiters[name] = SendRateLimiter(
+                float(get_setting("send_rate")),
+                float(get_setting("send_rate_min")),
+                float(get_setting("send_rate_max")),
+                float(get_setting("send_rate_step")),
+                int(get_setting("send_burst")),
+            )
+        return self.limiters[name]
+
+    def send_rate(self, session) -> float | None:
+        limiter = self.limiters.get(session["name"])
+        return limiter.rate if limiter else None
+
+    def set_balance(self, session, balance):
+        session["balance"] = balance
+        session["balance_updated"] = datetime.now()
+
+    def debit(self, session, amount):
+        """Subtract spent stars from the cached balance without asking Telegram"""
+        session["balance"] = max((session["balance"] or 0) - amount, 0)
+        if session["balance"] <= 0 and session["active"]:
+            session["active"] = False
+            logger.warning(f"{LOGGER_PREFIX} Session {session['name']} spent all cached stars, marked inactive")
+
+    def balances_stale(self) -> bool:
+        return self.balances_updated is None or datetime.now() - self.balances_updated > timedelta(seconds=BALANCE_TTL)
+
+    def schedule_refresh(self):
+        """Refresh cached balances in the background unless a refresh is already running"""
+        if self.refresh_task is None or self.refresh_task.done():
+            self.refresh_task = asyncio.ensure_future(self.check_all_sessions(notify=False))
+        return self.refresh_task
+
+    async def balance_refresh_loop(self):
+        while True:
+            await asyncio.sleep(BALANCE_TTL)
+            try:
+                await self.schedule_refresh()
+            except Exception as e:
+                logger.error(f"{LOGGER_PREFIX} Balance refresh loop error: {str(e)}")
 
-    async def get_active_session(self, order_id=None):
+    @metrics.timed("get_active_session")
+    async def get_active_session(self, order_id=None, required=0):
+        """Pick the next active session from the cached balances (round-robin)"""
         if not self.sessions:
             logger.error(f"{LOGGER_PREFIX} No sessions available")
             return None
-        await self.check_all_sessions(None, None)
-        active_sessions = [s for s in self.sessions if s['active'] and s['balance'] > 0]
-        
+        if self.balances_updated is None:
+            await self.schedule_refresh()
+        elif self.balances_stale():
+            self.schedule_refresh()
+
+        active_sessions = [s for s in self.sessions if s['active'] and (s['balance'] or 0) > 0]
         if not active_sessions:
             logger.error(f"{LOGGER_PREFIX} No active sessions with sufficient balance")
             return None
 
-        logger.info(f"{LOGGER_PREFIX} Available active sessions: {len(active_sessions)}")
         start_index = self.current_session_index % len(active_sessions)
-        
         for i in range(len(active_sessions)):
             session_index = (start_index + i) % len(active_sessions)
             session = active_sessions[session_index]
-            logger.info(f"{LOGGER_PREFIX} Checking session {session['name']} at index {session_index}")
-            
-            try:
-                async with Client(session["name"], workdir=SESSIONS_PATH) as app:
-                    balance = await app.get_stars_balance()
-                    session["balance"] = balance
-                    logger.info(f"{LOGGER_PREFIX} Session {session['name']} balance: {balance}")
-                    
-                    if balance > 0:
-                        self.current_session_index = (session_index + 1) % len(active_sessions)
-                        session["last_used"] = datetime.now()
-                        logger.info(f"{LOGGER_PREFIX} Selected session {session['name']} with balance {balance} for order #{order_id}")
-                        return session
-                    else:
-                        logger.warning(f"{LOGGER_PREFIX} Session {session['name']} has zero balance")
-                        session["active"] = False
-                        await self.notify_low_balance(session)
-            except Exception as e:
-                logger.error(f"{LOGGER_PREFIX} Error checking session {session['name']}: {str(e)}")
-                session["active"] = False
-                await self.notify_low_balance(session)
-        
-        logger.error(f"{LOGGER_PREFIX} No active sessions with sufficient balance after full cycle")
+            if session["balance"] >= required:
+                self.current_session_index = (session_index + 1) % len(active_sessions)
+                session["last_used"] = datetime.now()
+                logger.info("%s Selected session %s with balance %s for order #%s", LOGGER_PREFIX, session['name'], session['balance'], order_id)
+                return session
+
+        logger.error(f"{LOGGER_PREFIX} No session holds {required} stars for order #{order_id}")
         return None
-    async def notify_low_balance(self, session, bot=None, authorized_users=None):
+
+    def peek_active_session(self):
+        """Session get_active_session() would pick next, without rotating or refreshing"""
+        active_sessions = [s for s in self.sessions if s['active'] and (s['balance'] or 0) > 0]
+        if not active_sessions:
+            return None
+        return active_sessions[self.current_session_index % len(active_sessions)]
+
+    def notify_low_balance(self, session, notify=True):
         """Notify authorized users about low balance"""
-        if bot and authorized_users:
-            for user_id in authorized_users:
-                await bot.send_message(
-                    user_id,
-                    f"⚠️ Сессия {session['name']} имеет нулевой баланс звёзд! Пожалуйста, пополните баланс.",
-                    parse_mode='HTML'
-                )
+        if notify:
+            notifier.notify(
+                f"⚠️ Сессия {session['name']} имеет нулевой баланс звёзд! Пожалуйста, пополните баланс.",
+                key=f"low_balance:{session['name']}"
+            )
         logger.warning(f"{LOGGER_PREFIX} Session {session['name']} marked as inactive due to low balance")
 
-    async def check_all_sessions(self, bot, authorized_users):
-        """Check all sessions and notify about their status"""
-        for session in self.sessions:
-            async with Client(session["name"], workdir=SESSIONS_PATH) as app:
+    async def probe_session(self, session, notify=True, with_me=False):
+        """Fetch the star balance of one session and update its status"""
+        app = await self.get_client(session)
+        me = await app.get_me() if with_me else None
+        balance = await app.get_stars_balance()
+        self.set_balance(session, balance)
+        if me is not None:
+            logger.info("%s Session %s initialized: ID=%s, Balance=%s", LOGGER_PREFIX, session['name'], me.id, balance)
+        if balance == 0 and session["active"]:
+            session["active"] = False
+            self.notify_low_balance(session, notify)
+        elif balance > 0 and not session["active"]:
+            session["active"] = True
+            if notify:
+                notifier.notify(f"✅ Сессия {session['name']} восстановлена с балансом {balance} звёзд")
+
+    @metrics.timed("check_all_sessions")
+    async def check_all_sessions(self, notify=True, with_me=False):
+        """Check all sessions concurrently and notify about their status"""
+        semaphore = asyncio.Semaphore(max(int(get_setting("probe_concurrency")), 1))
+        timeout = get_setting("probe_timeout")
+
+        async def check(session):
+            async with semaphore:
                 try:
-                    balance = await app.get_stars_balance()
-                    session["balance"] = balance
-                    if balance == 0 and session["active"]:
-                        session["active"] = False
-                        await self.notify_low_balance(session, bot, authorized_users)
-                    elif balance > 0 and not session["active"]:
-                        session["active"] = True
-                        for user_id in authorized_users:
-                            await bot.send_message(
-                                user_id,
-                                f"✅ Сессия {session['name']} восстановлена с балансом {balance} звёзд",
-                                parse_mode='HTML'
-                            )
+                    with metrics.timer("probe_session", session=session["name"]):
+                        await asyncio.wait_for(self.probe_session(session, notify, with_me), timeout)
                 except Exception as e:
-                    logger.error(f"{LOGGER_PREFIX} Error checking session {session['name']}: {str(e)}")
+                    if isinstance(e, asyncio.TimeoutError):
+                        logger.error(f"{LOGGER_PREFIX} Session {session['name']} did not answer in {timeout}s")
+                    else:
+                        logger.error(f"{LOGGER_PREFIX} Error checking session {session['name']}: {str(e)}")
                     session["active"] = False
-                    await self.notify_low_balance(session, bot, authorized_users)
+                    await self.drop_client(session)
+                    self.notify_low_balance(session, notify)
+
+        await asyncio.gather(*(check(session) for session in self.sessions))
+        self.balances_updated = datetime.now()
+
 session_manager = SessionManager()
 
-async def inform():
-    for session in session_manager.sessions:
-        async with Client(session["name"], workdir=SESSIONS_PATH) as app:
+class GiftCatalog:
+    """Cached get_available_gifts() result indexed by gift_id"""
+    def __init__(self):
+        self.gifts: Dict[int, Dict] = {}
+        self.updated = None
+        self.refresh_task = None
+
+    def stale(self) -> bool:
+        return self.updated is None or datetime.now() - self.updated > timedelta(seconds=CATALOG_TTL)
+
+    async def refresh(self) -> bool:
+        session = await session_manager.get_active_session()
+        if not session:
+            logger.error(f"{LOGGER_PREFIX} No active sessions to refresh gift catalog")
+            return False
+        try:
+            app = await session_manager.get_client(session)
+            gifts = await app.get_available_gifts()
+        except Exception as e:
+            logger.error(f"{LOGGER_PREFIX} Error refreshing gift catalog with session {session['name']}: {str(e)}")
+            return False
+        self.gifts = {
+            gift.id: {
+                "price": gift.price,
+                "is_limited": bool(getattr(gift, "is_limited", False)),
+                "is_sold_out": bool(getattr(gift, "is_sold_out", False)),
+                "available_amount": getattr(gift, "available_amount", None),
+                "total_amount": getattr(gift, "total_amount", None),
+            }
+            for gift in gifts
+        }
+        self.updated = datetime.now()
+        logger.info("%s Gift catalog refreshed: %s gifts", LOGGER_PREFIX, len(self.gifts))
+        return True
+
+    def schedule_refresh(self):
+        if self.refresh_task is None or self.refresh_task.done():
+            self.refresh_task = asyncio.ensure_future(self.refresh())
+        return self.refresh_task
+
+    async def refresh_loop(self):
+        while True:
+            await asyncio.sleep(CATALOG_TTL)
             try:
-                me = await app.get_me()
-                stars = await app.get_stars_balance()
-                session["balance"] = stars
-                logger.info(f"{LOGGER_PREFIX} Session {session['name']} initialized: ID={me.id}, Balance={stars}")
+                await self.schedule_refresh()
             except Exception as e:
-                logger.error(f"{LOGGER_PREFIX} Error initializing session {session['name']}: {str(e)}")
-                session["active"] = False
+                logger.error(f"{LOGGER_PREFIX} Gift catalog refresh loop error: {str(e)}")
+
+    async def get(self, gift_id) -> Dict | None:
+        if self.updated is None:
+            await self.schedule_refresh()
+        elif self.stale():
+            self.schedule_refresh()
+        gift = self.gifts.get(gift_id)
+        if gift is None and self.updated is not None and datetime.now() - self.updated > timedelta(seconds=CATALOG_MISS_COOLDOWN):
+            # Подарок мог появиться после последнего обновления
+            await self.schedule_refresh()
+            gift = self.gifts.get(gift_id)
+        return gift
+
+    def is_sold_out(self, gift_id, amount=1) -> bool:
+        """Cached view: the gift is sold out or has fewer than amount left"""
+        gift = self.gifts.get(gift_id)
+        if gift is None:
+            return False
+        available = gift["available_amount"]
+        return gift["is_sold_out"] or (gift["is_limited"] and available is not None and available < amount)
+
+    def mark_sold_out(self, gift_id):
+        gift = self.gifts.get(gift_id)
+        if gift is not None:
+            gift["is_sold_out"] = True
+            gift["available_amount"] = 0
+
+gift_catalog = GiftCatalog()
 
-loop = asyncio.new_event_loop()
-try:
-    loop.run_until_complete(inform())
-finally:
-    loop.close()
+async def inform():
+    await session_manager.check_all_sessions(notify=False, with_me=True)
+
+def shutdown():
+    """Stop pooled clients and the background loop, flush buffered stats"""
+    notifier.stop()
+    metrics.stop()
+    if runner.running:
+        try:
+            runner.run(session_manager.close_clients(), timeout=30)
+        except Exception as e:
+            logger.error(f"{LOGGER_PREFIX} Error during shutdown: {str(e)}")
+        runner.stop()
+    session_manager.save_session_stats()
+    if metrics.dirty and get_setting("metrics_interval") > 0:
+        metrics.write()
+    log_pipeline.stop()
+
+atexit.register(shutdown)
+
+_config_cache: Dict | None = None
+_config_mtime = None
+_config_lock = threading.RLock()
+
+def _config_file_mtime():
+    try:
+        return os.stat(CONFIG_PATH).st_mtime_ns
+    except FileNotFoundError:
+        return None
 
 def save_config(cfg: Dict):
-    logger.info(f"{LOGGER_PREFIX} Saving configuration (gift_lots.json)...")
-    os.makedirs(os.path.dirname(CONFIG_PATH), exist_ok=True)
-    with open(CONFIG_PATH, 'w', encoding='utf-8') as f:
-        json.dump(cfg, f, ensure_ascii=False, indent=4)
-    logger.info(f"{LOGGER_PREFIX} Configuration saved")
+    global _config_cache, _config_mtime
+    logger.info("%s Saving configuration (gift_lots.json)...", LOGGER_PREFIX)
+    with _config_lock:
+        atomic_write_json(CONFIG_PATH, cfg)
+        _config_cache = copy.deepcopy(cfg)
+        _config_mtime = _config_file_mtime()
+        set_lot_mapping(_config_cache.get("lot_mapping", {}))
+    logger.info("%s Configuration saved", LOGGER_PREFIX)
+
+def _cached_config() -> Dict:
+    """Process-wide config, re-read only when gift_lots.json changes on disk"""
+    global _config_cache, _config_mtime
+    with _config_lock:
+        mtime = _config_file_mtime()
+        if _config_cache is not None and mtime == _config_mtime:
+            return _config_cache
+        if mtime is None:
+            logger.info("%s Configuration file not found, creating default", LOGGER_PREFIX)
+            default_config = {
+                "lot_mapping": {
+                    "lot_1": {
+                        "name": "Тестовый лот",
+                        "gift_id": 5170690322832818290,
+                        "gift_name": "Кольцо 💍"
+                    }
+                },
+                **DEFAULT_SETTINGS
+            }
+            save_config(default_config)
+            return _config_cache
+
+        logger.info("%s Loading configuration (gift_lots.json)...", LOGGER_PREFIX)
+        try:
+            with open(CONFIG_PATH, 'r', encoding='utf-8') as f:
+                cfg = json.load(f)
+        except json.JSONDecodeError as e:
+            if _config_cache is None:
+                raise
+            logger.error(f"{LOGGER_PREFIX} gift_lots.json is not valid JSON, keeping the cached configuration: {e}")
+            return _config_cache
+        missing = [key for key in DEFAULT_SETTINGS if key not in cfg]
+        for key in missing:
+            cfg[key] = DEFAULT_SETTINGS[key]
+        if missing:
+            save_config(cfg)
+        else:
+            _config_cache = cfg
+            _config_mtime = mtime
+            set_lot_mapping(cfg.get("lot_mapping", {}))
+        logger.info("%s Configuration loaded successfully", LOGGER_PREFIX)
+        return _config_cache
 
 def load_config() -> Dict:
-    logger.info(f"{LOGGER_PREFIX} Loading configuration (gift_lots.json)...")
-    if os.path.exists(CONFIG_PATH):
-        with open(CONFIG_PATH, 'r', encoding='utf-8') as f:
-            cfg = json.load(f)
-        if "auto_refunds" not in cfg:
-            cfg["auto_refunds"] = True
-        if "active_lots" not in cfg:
-            cfg['active_lots'] = True
-        save_config(cfg)
-        logger.info(f"{LOGGER_PREFIX} Configuration loaded successfully")
-        return cfg
-    else:
-        logger.info(f"{LOGGER_PREFIX} Configuration file not found, creating default")
-        default_config = {
-            "lot_mapping": {
-                "lot_1": {
-                    "name": "Тестовый лот",
-                    "gift_id": 5170690322832818290,
-                    "gift_name": "Кольцо 💍"
-                }
-            },
-            "auto_refunds": True,
-            "active_lots": True
-        }
-        save_config(default_config)
-        return default_config
+    """Return a private copy of the configuration, callers may modify it and pass it to save_config"""
+    return copy.deepcopy(_cached_config())
+
+def get_setting(key: str):
+    return _cached_config().get(key, DEFAULT_SETTINGS.get(key))
+
+class OrderStateStore:
+    """Pending order conversations keyed by order_id, indexed by buyer and chat, persisted on every change"""
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.RLock()
+        self.orders: Dict[str, Dict] = {}
+        self.by_buyer: Dict[str, List[str]] = {}
+        self.by_chat: Dict[str, List[str]] = {}
+        self.load()
+
+    def _index(self, data: Dict):
+        key = str(data["order_id"])
+        self.by_buyer.setdefault(str(data["buyer_id"]), []).append(key)
+        self.by_chat.setdefault(str(data["chat_id"]), []).append(key)
+
+    def _unindex(self, data: Dict):
+        key = str(data["order_id"])
+        for index, index_key in ((self.by_buyer, str(data["buyer_id"])), (self.by_chat, str(data["chat_id"]))):
+            keys = index.get(index_key, [])
+            if key in keys:
+                keys.remove(key)
+            if not keys:
+                index.pop(index_key, None)
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r', encoding='utf-8') as f:
+            saved = json.load(f)
+        with self.lock:
+            for data in saved:
+                self.orders[str(data["order_id"])] = data
+                self._index(data)
+        logger.info("%s Restored %s pending orders from %s", LOGGER_PREFIX, len(self.orders), self.path)
+
+    def save(self):
+        with self.lock:
+            atomic_write_json(self.path, list(self.orders.values()))
+
+    def add(self, data: Dict):
+        with self.lock:
+            old = self.orders.get(str(data["order_id"]))
+            if old is not None:
+                self._unindex(old)
+            self.orders[str(data["order_id"])] = data
+            self._index(data)
+            self.save()
+
+    def update(self, order_id, **changes):
+        with self.lock:
+            data = self.orders.get(str(order_id))
+            if data is None:
+                return None
+            data.update(changes)
+            self.save()
+            return data
+
+    def remove(self, order_id):
+        with self.lock:
+            data = self.orders.pop(str(order_id), None)
+            if data is not None:
+                self._unindex(data)
+                self.save()
+            return data
+
+    def get(self, order_id) -> Dict | None:
+        return self.orders.get(str(order_id))
+
+    def for_buyer(self, buyer_id) -> List[Dict]:
+        with self.lock:
+            return [self.orders[key] for key in self.by_buyer.get(str(buyer_id), [])]
+
+    def for_chat(self, chat_id) -> List[Dict]:
+        with self.lock:
+            return [self.orders[key] for key in self.by_chat.get(str(chat_id), [])]
+
+    def find_conversation(self, buyer_id, chat_id) -> Dict | None:
+        """Oldest order of the buyer in this chat that still waits for input, else one being delivered"""
+        orders = [o for o in self.for_buyer(buyer_id) if str(o["chat_id"]) == str(chat_id)] or self.for_buyer(buyer_id)
+        waiting = [o for o in orders if o["step"] != "sending"]
+        if waiting:
+            return waiting[0]
+        return orders[0] if orders else None
+
+order_store = OrderStateStore(ORDER_STATE_PATH)
+
+class FulfilmentJournal:
+    """Append-only log of every gift already sent per order, so a retry only sends the rest"""
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.sent: Dict[str, int] = {}
+        self.file = None
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # Оборванная при падении последняя строка: подарок по ней не засчитываем
+                    logger.warning(f"{LOGGER_PREFIX} Skipping damaged fulfilment record: {line.strip()[:100]}")
+                    continue
+                key = str(entry["order_id"])
+                if entry.get("done"):
+                    self.sent.pop(key, None)
+                else:
+                    self.sent[key] = self.sent.get(key, 0) + entry.get("count", 1)
+        self._compact()
+        if self.sent:
+            logger.info("%s Restored partial fulfilment of %s orders from %s", LOGGER_PREFIX, len(self.sent), self.path)
+
+    def _compact(self):
+        """Rewrite the journal with only the orders that are still open"""
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        lines = [json.dumps({"order_id": key, "count": count}) + "\n" for key, count in self.sent.items()]
+        directory = os.path.dirname(self.path) or "."
+        os.makedirs(directory, exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.writelines(lines)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def _append(self, entry: Dict):
+        if self.file is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self.file = open(self.path, 'a', encoding='utf-8')
+        self.file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def record(self, order_id, session_name: str):
+        """Durably note one delivered gift; called right after send_gift returns"""
+        with self.lock:
+            self._append({"order_id": str(order_id), "session": session_name, "time": time.time()})
+            self.sent[str(order_id)] = self.sent.get(str(order_id), 0) + 1
+
+    def sent_count(self, order_id) -> int:
+        return self.sent.get(str(order_id), 0)
+
+    def remaining(self, data: Dict) -> int:
+        return max(data["order_amount"] - self.sent_count(data["order_id"]), 0)
+
+    def close(self, order_id):
+        """Forget a finished (or refunded) order; the journal is truncated once nothing is open"""
+        with self.lock:
+            if self.sent.pop(str(order_id), None) is None:
+                return
+            if self.sent:
+                self._append({"order_id": str(order_id), "done": True})
+            else:
+                self._compact()
 
-queue: Dict[str, Dict] = {}
+fulfilment = FulfilmentJournal(ORDER_FULFILMENT_PATH)
 
-def get_authorized_users() -> List[int]:
-    path_ = os.path.join("storage", "cache", "tg_authorized_users.json")
-    if not os.path.exists(path_):
-        return []
-    try:
-        with open(path_, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            return [int(k) for k in data.keys()]
-    except:
-        return []
+class AdminNotifier:
+    """Admin alerts sent from a background thread: cached admin list, per-chat pacing, repeats folded into digests"""
+    def __init__(self):
+        self.bot = None
+        self.lock = threading.Lock()
+        self.outbox: queue.Queue = queue.Queue()
+        self.recent: Dict[str, Dict] = {}
+        self.limiters: Dict[int, BlockingRateLimiter] = {}
+        self.admins: List[int] = []
+        self.admins_mtime = None
+        self.thread = None
+        self.stopping = threading.Event()
+
+    def authorized_users(self) -> List[int]:
+        """Admin ids from tg_authorized_users.json, re-read only when the file changes"""
+        try:
+            mtime = os.path.getmtime(AUTHORIZED_USERS_PATH)
+        except OSError:
+            mtime = None
+        with self.lock:
+            if mtime != self.admins_mtime:
+                admins = []
+                if mtime is not None:
+                    try:
+                        with open(AUTHORIZED_USERS_PATH, "r", encoding="utf-8") as f:
+                            admins = [int(k) for k in json.load(f).keys()]
+                    except Exception as e:
+                        logger.warning(f"{LOGGER_PREFIX} Error reading {AUTHORIZED_USERS_PATH}: {str(e)}")
+                self.admins = admins
+                self.admins_mtime = mtime
+            return list(self.admins)
+
+    def start(self, bot):
+        self.bot = bot
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self.run, name="auto-gifts-notify", daemon=True)
+        self.thread.start()
 
+    def stop(self, timeout=NOTIFY_DRAIN_TIMEOUT):
+        """Let the sender drain the outbox (pending digests included), then report what did not make it"""
+        if self.thread is None:
+            return
+        self.stopping.set()
+        self.thread.join(timeout)
+        if self.thread.is_alive():
+            logger.warning(f"{LOGGER_PREFIX} Admin alerts not delivered within {timeout}s of shutdown, dropping {self.outbox.qsize()} queued")
+        self.thread = None
+
+    def notify(self, text: str, key: str | None = None):
+        """Queue an alert for every admin; repeats of key within the window only bump a counter"""
+        key = key or text
+        now = time.monotonic()
+        with self.lock:
+            entry = self.recent.get(key)
+            if entry is not None:
+                entry["repeats"] += 1
+                entry["text"] = text
+                return
+            self.recent[key] = {"since": now, "repeats": 0, "text": text}
+        self.outbox.put(text)
+
+    def _flush_digests(self, force=False):
+        window = get_setting("notify_coalesce_window")
+        now = time.monotonic()
+        with self.lock:
+            expired = [key for key, entry in self.recent.items() if force or now - entry["since"] >= window]
+            for key in expired:
+                entry = self.recent.pop(key)
+                if entry["repeats"]:
+                    self.outbox.put(f"🔁 Повторилось ещё {entry['repeats']} раз за {int(now - entry['since'])} сек. Последнее:\n{entry['text']}")
+
+    def _send(self, user_id, text):
+        rate = get_setting("notify_rate")
+        limiter = self.limiters.get(user_id)
+        if limiter is None:
+            limiter = self.limiters[user_id] = BlockingRateLimiter(rate)
+        limiter.set_rate(rate)
+        for attempt in range(3):
+            limiter.acquire()
+            try:
+                self.bot.send_message(user_id, text, parse_mode='HTML')
+                return
+            except Exception as e:
+                retry_after = (getattr(e, "result_json", None) or {}).get("parameters", {}).get("retry_after")
+                if getattr(e, "error_code", None) == 429 and retry_after:
+                    logger.warning(f"{LOGGER_PREFIX} Telegram asked to wait {retry_after}s before notifying {user_id}")
+                    time.sleep(retry_after)
+                    continue
+                logger.error(f"{LOGGER_PREFIX} Error notifying admin {user_id}: {type(e).__name__}: {str(e)}")
+                return
+
+    def run(self):
+        while True:
+            stopping = self.stopping.is_set()
+            # При остановке сводки отправляются сразу, не дожидаясь конца окна
+            self._flush_digests(force=stopping)
+            if stopping and self.outbox.empty():
+                break
+            try:
+                text = self.outbox.get(timeout=1)
+            except queue.Empty:
+                continue
+            for user_id in self.authorized_users():
+                self._send(user_id, text)
+
+notifier = AdminNotifier()
+
+class UsernameCache:
+    """LRU+TTL cache of resolved usernames shared by all sessions, with short-lived negative entries"""
+    def __init__(self, max_size: int, ttl: float, negative_ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.lock = threading.Lock()
+        self.entries: OrderedDict[str, Dict] = OrderedDict()
+
+    def get(self, username) -> Dict | None:
+        key = username.lower()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if time.monotonic() >= entry["expires"]:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def _put(self, username, entry: Dict):
+        key = username.lower()
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def put(self, username, peer_id, peer_type, name, session_name):
+        self._put(username, {
+            "valid": True,
+            "id": peer_id,
+            "type": peer_type,
+            "name": name,
+            "sessions": {session_name},
+            "expires": time.monotonic() + self.ttl
+        })
+
+    def put_invalid(self, username):
+        self._put(username, {"valid": False, "expires": time.monotonic() + self.negative_ttl})
+
+    def invalidate(self, username):
+        with self.lock:
+            self.entries.pop(username.lower(), None)
+
+    def peer_for(self, username, session_name):
+        """Peer id if this session already resolved the username (pyrogram keeps it in the session storage)"""
+        entry = self.get(username)
+        if entry is not None and entry["valid"] and session_name in entry["sessions"]:
+            return entry["id"]
+        return username
+
+    def mark_resolved(self, username, session_name):
+        entry = self.get(username)
+        if entry is not None and entry["valid"]:
+            entry["sessions"].add(session_name)
+
+username_cache = UsernameCache(USERNAME_CACHE_SIZE, USERNAME_TTL, USERNAME_NEGATIVE_TTL)
+
+@metrics.timed("check_username")
 async def check_username(c: Cardinal, msg_chat_id, username, order_id):
-    msg_author_id = c.account.id
-    data = queue.get(msg_author_id, {})
+    invalid_text = "🐒 Юзернейм не распознан!\nВспоминаем: должен быть знак @ и ник.\nВот так правильно: @example\nПопробуй ещё раз 👇"
+    if not USERNAME_RE.match(username):
+        logger.debug("%s Username %s failed the local format check for order #%s", LOGGER_PREFIX, username, order_id)
+        await to_thread(send_funpay_message, c, msg_chat_id, invalid_text)
+        return None
+    cached = username_cache.get(username)
+    if cached is not None:
+        logger.debug("%s Username %s served from cache for order #%s (valid: %s)", LOGGER_PREFIX, username, order_id, cached['valid'])
+        if not cached["valid"]:
+            await to_thread(send_funpay_message, c, msg_chat_id, invalid_text)
+            return None
+        return cached["name"]
+
+    data = order_store.get(order_id) or {}
     session_name = data.get("session_name")
     session = next((s for s in session_manager.sessions if s["name"] == session_name), None)
     
@@ -287,26 +1298,34 @@ async def check_username(c: Cardinal, msg_chat_id, username, order_id):
         session = await session_manager.get_active_session(order_id)
         if not session:
             logger.error(f"{LOGGER_PREFIX} No active sessions for username check, order #{order_id}")
-            c.send_message(msg_chat_id, "❌ Нет доступных сессий для обработки заказа. Свяжитесь с продавцом.")
+            await to_thread(send_funpay_message, c, msg_chat_id, "❌ Нет доступных сессий для обработки заказа. Свяжитесь с продавцом.")
             return None
-        data["session_name"] = session["name"]
+        order_store.update(order_id, session_name=session["name"])
     
-    async with Client(session["name"], workdir=SESSIONS_PATH) as app:
-        try:
+    try:
+        app = await session_manager.get_client(session)
+        with metrics.timer("get_chat", session=session["name"]):
             user = await app.get_chat(username)
-            if user.type in (ChatType.PRIVATE, ChatType.CHANNEL):
-                name = clean_display_name(user.first_name)  # Очищаем имя
-                logger.debug(f"{LOGGER_PREFIX} Got name: {name} for order #{order_id}")
-                return name
-            else:
-                logger.debug(f"{LOGGER_PREFIX} Got {user.type} for order #{order_id}")
-                c.send_message(msg_chat_id, "🐒 Юзернейм не распознан!\nВспоминаем: должен быть знак @ и ник.\nВот так правильно: @example\nПопробуй ещё раз 👇")
-                return None
-        except Exception as e:
-            logger.error(f"{LOGGER_PREFIX} Error processing username {username} for order #{order_id}: {str(e)}")
-            c.send_message(msg_chat_id, "🐒 Юзернейм не распознан!\nВспоминаем: должен быть знак @ и ник.\nВот так правильно: @example\nПопробуй ещё раз 👇")
+        if user.type in (ChatType.PRIVATE, ChatType.CHANNEL):
+            name = clean_display_name(user.first_name)  # Очищаем имя
+            username_cache.put(username, user.id, user.type, name, session["name"])
+            logger.debug("%s Got name: %s for order #%s", LOGGER_PREFIX, name, order_id)
+            return name
+        else:
+            logger.debug("%s Got %s for order #%s", LOGGER_PREFIX, user.type, order_id)
+            username_cache.put_invalid(username)
+            await to_thread(send_funpay_message, c, msg_chat_id, invalid_text)
             return None
-        
+    except (UsernameNotOccupied, UsernameInvalid) as e:
+        logger.debug("%s Username %s does not exist, order #%s: %s", LOGGER_PREFIX, username, order_id, e)
+        username_cache.put_invalid(username)
+        await to_thread(send_funpay_message, c, msg_chat_id, invalid_text)
+        return None
+    except Exception as e:
+        logger.error(f"{LOGGER_PREFIX} Error processing username {username} for order #{order_id}: {str(e)}")
+        await to_thread(send_funpay_message, c, msg_chat_id, invalid_text)
+        return None
+
 async def clean_comment(comment: str | None) -> str:
     """Очищает комментарий для отправки через Telegram API."""
     if not comment:
@@ -315,106 +1334,377 @@ async def clean_comment(comment: str | None) -> str:
     comment = comment.replace('*', '\\*').replace('_', '\\_').replace('`', '\\`')
     return comment[:200]
 
-async def buy_gifts(c: Cardinal, msg_chat_id, username, gift_id, order_amount, order_id, bot, comment=None, is_anonymous=True):
+async def buy_gifts(c: Cardinal, msg_chat_id, username, gift_id, order_amount, order_id, comment=None, is_anonymous=True, session=None):
     gift_price = await get_amount(gift_id)
     if gift_price is None:
         logger.error(f"{LOGGER_PREFIX} Failed to get gift price for gift_id {gift_id}, order #{order_id}")
-        await bot.send_message(msg_chat_id, f"❌ Ошибка: не удалось определить стоимость подарка для заказа #{order_id}.", parse_mode='HTML')
+        await to_thread(send_funpay_message, c, msg_chat_id, f"❌ Ошибка: не удалось определить стоимость подарка для заказа #{order_id}.")
         return False
 
     for attempt in range(len(session_manager.sessions)):
-        session = await session_manager.get_active_session(order_id)
+        if session is None or not session["active"] or (session["balance"] or 0) < gift_price * order_amount:
+            session = await session_manager.get_active_session(order_id, gift_price * order_amount)
         if not session:
             logger.error(f"{LOGGER_PREFIX} No active sessions for sending gifts, order #{order_id}")
-            await bot.send_message(msg_chat_id, "❌ Нет активных сессий для отправки подарков. Свяжитесь с продавцом.", parse_mode='HTML')
-            for user_id in get_authorized_users():
-                await bot.send_message(user_id, f"⚠️ Нет активных сессий для обработки заказа #{order_id}", parse_mode='HTML')
+            await to_thread(send_funpay_message, c, msg_chat_id, "❌ Нет активных сессий для отправки подарков. Свяжитесь с продавцом.")
+            notifier.notify(f"⚠️ Нет активных сессий для обработки заказа #{order_id}", key="no_sessions")
             return False
 
-        logger.debug(f"{LOGGER_PREFIX} Selected session {session['name']} for order #{order_id}, balance: {session['balance']}")
+        logger.debug("%s Selected session %s for order #%s, balance: %s", LOGGER_PREFIX, session['name'], order_id, session['balance'])
 
         if session["balance"] < gift_price * order_amount:
             logger.warning(f"{LOGGER_PREFIX} Insufficient balance in session {session['name']} for order #{order_id}. Required: {gift_price * order_amount}, Available: {session['balance']}")
             session["active"] = False
-            await session_manager.notify_low_balance(session, bot, get_authorized_users())
+            session_manager.notify_low_balance(session)
+            session = None
             continue
 
-        async with Client(session["name"], workdir=SESSIONS_PATH) as app:
-            logger.debug(f"{LOGGER_PREFIX} Starting gift sending for order #{order_id}, username: {username}, gift_id: {gift_id}, session: {session['name']}, comment: {comment}, anonymous: {is_anonymous}")
-            gift_text = await clean_comment(comment)
+        app = await session_manager.get_client(session)
+        limiter = session_manager.limiter(session)
+        logger.debug("%s Starting gift sending for order #%s, username: %s, gift_id: %s, session: %s, comment: %s, anonymous: %s", LOGGER_PREFIX, order_id, username, gift_id, session['name'], comment, is_anonymous)
+        gift_text = await clean_comment(comment)
 
-            for gift_num in range(order_amount):
-                logger.debug(f"{LOGGER_PREFIX} Attempt {gift_num+1}/{order_amount} for order #{order_id}")
-                try:
-                    result = await app.send_gift(chat_id=username, gift_id=gift_id, is_private=is_anonymous, text=gift_text)
-                    logger.info(f"{LOGGER_PREFIX} Successfully sent gift #{gift_num+1}/{order_amount} for order #{order_id} using session {session['name']}")
-                    session["gifts_sent"] += 1
-                    session["total_cost"] += gift_price
-                    session_manager.save_session_stats()
-                    await asyncio.sleep(1)
-                except StargiftUsageLimited as e:
-                    logger.error(f"{LOGGER_PREFIX} Error: Gift sold out for order #{order_id}. Details: {str(e)}")
-                    await bot.send_message(msg_chat_id, "❌ Этот подарок распродан! Напишите #help для связи с продавцом.", parse_mode='HTML')
-                    for user_id in get_authorized_users():
-                        await bot.send_message(user_id, f"❌ Подарок распродан для заказа #{order_id}: {str(e)}", parse_mode='HTML')
-                    return False
-                except Exception as e:
-                    logger.error(f"{LOGGER_PREFIX} Error sending gift #{gift_num+1} for order #{order_id} using session {session['name']}: {type(e).__name__}: {str(e)}")
-                    await bot.send_message(msg_chat_id, f"❌ Произошла ошибка при обработке заказа #{order_id}. Свяжитесь с продавцом.\nПодробности: {str(e)}", parse_mode='HTML')
-                    for user_id in get_authorized_users():
-                        await bot.send_message(user_id, f"❌ Ошибка при обработке заказа #{order_id} с сессией {session['name']}: {type(e).__name__}: {str(e)}", parse_mode='HTML')
+        gift_num = 0
+        failures = 0
+        while gift_num < order_amount:
+            logger.debug("%s Attempt %s/%s for order #%s", LOGGER_PREFIX, gift_num+1, order_amount, order_id)
+            await limiter.acquire()
+            try:
+                if app is None:
+                    app = await session_manager.get_client(session)
+                with metrics.timer("send_gift", session=session["name"], gift=gift_id):
+                    result = await app.send_gift(
+                        chat_id=username_cache.peer_for(username, session["name"]),
+                        gift_id=gift_id, is_private=is_anonymous, text=gift_text
+                    )
+                await to_thread(fulfilment.record, order_id, session["name"])
+                username_cache.mark_resolved(username, session["name"])
+                limiter.on_success()
+                logger.info("%s Successfully sent gift #%s/%s for order #%s using session %s", LOGGER_PREFIX, gift_num+1, order_amount, order_id, session['name'])
+                session_manager.record_gift(session, gift_price)
+                session_manager.debit(session, gift_price)
+                gift_num += 1
+                failures = 0
+            except FloodWait as e:
+                if e.value > MAX_FLOOD_WAIT:
+                    limiter.on_flood_wait(e.value)
+                    logger.error(f"{LOGGER_PREFIX} FloodWait of {e.value}s on session {session['name']} for order #{order_id}, giving up")
                     session["active"] = False
-                    await session_manager.notify_low_balance(session, bot, get_authorized_users())
+                    await to_thread(send_funpay_message, c, msg_chat_id, f"❌ Произошла ошибка при обработке заказа #{order_id}. Свяжитесь с продавцом.\nПодробности: Telegram ограничил отправку на {e.value} сек.")
+                    notifier.notify(f"❌ FloodWait {e.value} сек. на сессии {session['name']} при обработке заказа #{order_id}", key=f"flood_wait:{session['name']}")
                     return False
+                logger.warning(f"{LOGGER_PREFIX} FloodWait {e.value}s on session {session['name']} for order #{order_id}, retrying gift #{gift_num+1}")
+                limiter.on_flood_wait(e.value)
+            except StargiftUsageLimited as e:
+                logger.error(f"{LOGGER_PREFIX} Error: Gift sold out for order #{order_id}. Details: {str(e)}")
+                gift_catalog.mark_sold_out(gift_id)
+                await to_thread(send_funpay_message, c, msg_chat_id, "❌ Этот подарок распродан! Напишите #help для связи с продавцом.")
+                notifier.notify(f"❌ Подарок распродан для заказа #{order_id}: {str(e)}", key=f"sold_out:{gift_id}")
+                return False
+            except Exception as e:
+                failures += 1
+                username_cache.invalidate(username)
+                if failures < MAX_SEND_RETRIES:
+                    # Разовый сбой RPC или сети: переждать и повторить тот же подарок, сессию не трогаем
+                    delay = SEND_RETRY_BACKOFF * 2 ** (failures - 1)
+                    logger.warning(f"{LOGGER_PREFIX} Error sending gift #{gift_num+1} for order #{order_id} using session {session['name']} ({failures}/{MAX_SEND_RETRIES}), retrying in {delay}s: {type(e).__name__}: {str(e)}")
+                    limiter.on_error(delay)
+                    app = None
+                    continue
+                logger.error(f"{LOGGER_PREFIX} Error sending gift #{gift_num+1} for order #{order_id} using session {session['name']}, {failures} failures in a row: {type(e).__name__}: {str(e)}")
+                await to_thread(send_funpay_message, c, msg_chat_id, f"❌ Произошла ошибка при обработке заказа #{order_id}. Свяжитесь с продавцом.\nПодробности: {str(e)}")
+                notifier.notify(f"❌ Ошибка при обработке заказа #{order_id} с сессией {session['name']}: {type(e).__name__}: {str(e)}\nСессия отключена после {failures} ошибок подряд.", key=f"send_error:{session['name']}:{type(e).__name__}")
+                session["active"] = False
+                await session_manager.drop_client(session)
+                return False
 
-            logger.info(f"{LOGGER_PREFIX} All {order_amount} gifts sent successfully for order #{order_id} using session {session['name']}")
-            return True
+        logger.info("%s All %s gifts sent successfully for order #%s using session %s", LOGGER_PREFIX, order_amount, order_id, session['name'])
+        return True
 
     logger.error(f"{LOGGER_PREFIX} Exhausted all sessions for order #{order_id}")
     return False
 
-async def get_balance():
-    session = await session_manager.get_active_session()
-    if not session:
-        return 0
-    async with Client(session["name"], workdir=SESSIONS_PATH) as app:
-        try:
-            stars = await app.get_stars_balance()
-            session["balance"] = stars
-            return stars
-        except Exception as e:
-            logger.error(f"{LOGGER_PREFIX} Error getting balance for session {session['name']}: {str(e)}")
-            session["active"] = False
-            return 0
+def report_order_result(c: Cardinal, data: Dict, result: bool, error: Exception | None = None):
+    """Tell the buyer and the admins how a dispatched order ended"""
+    msg_chat_id = data["chat_id"]
+    order_id = data["order_id"]
+    if error is not None:
+        logger.error(f"{LOGGER_PREFIX} Error processing order #{order_id}: {type(error).__name__}: {str(error)}")
+        notifier.notify(f"❌ Ошибка при обработке заказа #{order_id}: {type(error).__name__}: {str(error)}", key=f"order_error:{type(error).__name__}")
+        send_funpay_message(
+            c,
+            msg_chat_id,
+            f"❌ Произошла ошибка при обработке заказа #{order_id}. Свяжитесь с продавцом.\nПодробности: {str(error)}"
+        )
+        result = False
+    if not result:
+        sent = fulfilment.sent_count(order_id)
+        if sent:
+            # Часть подарков уже у получателя: username не меняем, повтор отправит только остаток
+            logger.warning(f"{LOGGER_PREFIX} Gift sending failed for order #{order_id} after {sent}/{data['order_amount']} gifts, waiting for confirmation to resume")
+            order_store.update(order_id, step="await_confirm")
+            send_funpay_message(
+                c,
+                msg_chat_id,
+                f"⚠️ Отправлено {sent} из {data['order_amount']} подарков на @{data['username']}.\n✅ Отправьте + чтобы довыдать оставшиеся."
+            )
+            return
+        logger.warning(f"{LOGGER_PREFIX} Gift sending failed for order #{order_id}, returning to username input")
+        order_store.update(order_id, step="await_username")
+        send_funpay_message(
+            c,
+            msg_chat_id,
+            "📍 Отправьте ещё раз ваш @username"
+        )
+        return
+    order_url = f"https://funpay.com/orders/{order_id}/"
+    success_text = (
+        f"✅ Готово! Подарки успешно отправлены {'в приватном режиме' if data['is_anonymous'] else 'открыто'} 🎉\n"
+        f"💬 Не забудь подтвердить заказ и оставить отзыв — это важно!\n\n"
+        f"🔗 Ссылка для подтверждения:\n{order_url}"
+    )
+    send_funpay_message(c, msg_chat_id, success_text)
+    logger.info("%s Order #%s successfully completed", LOGGER_PREFIX, order_id)
+    current_time = datetime.now().strftime("%H:%M:%S")
+    text = (
+        f"🎉 Заказ <a href='https://funpay.com/orders/{order_id}/'>{order_id}</a> выполнен!\n\n"
+        f"👤 <b>Username:</b> @{data['username']}\n"
+        f"📝 <b>Ник в системе:</b> {data['name'] if data['name'] else 'не указано'}\n"
+        f"🎁 <b>Подарков:</b> {data['order_amount']} × {data['amount']} ⭐️ ({data['gift_name']})\n"
+        f"💬 <b>Комментарий:</b> {data['comment'] if data['comment'] else 'Рандомный (анонимно)'}\n"
+        f"💸 <b>Оплачено:</b> {data['order_price']} ₽\n"
+        f"💰 <b>Чистый профит:</b> {data['order_profit']} ₽\n\n"
+        f"⏳ <b>Добавлен в очередь:</b> <code>{data['order_time']}</code>\n"
+        f"✅ <b>Завершён:</b> <code>{current_time}</code>\n"
+        f"📡 <b>Сессия:</b> {data.get('session_name')}"
+    )
+    notifier.notify(text)
+    order_store.remove(order_id)
+    fulfilment.close(order_id)
+    logger.debug("%s Order #%s removed from pending orders", LOGGER_PREFIX, order_id)
+    session_manager.save_session_stats()
+
+class OrderDispatcher:
+    """Confirmed orders go to per-session queues, one worker per session delivers them"""
+    def __init__(self):
+        self.queues: Dict[str, asyncio.Queue] = {}
+        self.workers: Dict[str, asyncio.Task] = {}
+        self.reserved: Dict[str, int] = {}
+        self.busy: Dict[str, int] = {}
+
+    def load(self, session) -> int:
+        name = session["name"]
+        queued = self.queues[name].qsize() if name in self.queues else 0
+        return queued + self.busy.get(name, 0)
+
+    def free_balance(self, session, use_reserved=True) -> int:
+        balance = session["balance"] or 0
+        return balance - self.reserved.get(session["name"], 0) if use_reserved else balance
+
+    def pick_session(self, required, preferred=None):
+        """Least loaded active session that can cover the order, preferring free (unreserved) stars"""
+        active = [s for s in session_manager.sessions if s["active"] and (s["balance"] or 0) > 0]
+        for use_reserved in (True, False):
+            candidates = [s for s in active if self.free_balance(s, use_reserved) >= required]
+            if candidates:
+                return min(candidates, key=lambda s: (self.load(s), s is not preferred))
+        return None
+
+    def plan_shards(self, gift_price, order_amount) -> List[Tuple[Dict, int]] | None:
+        """Spread the gifts over several sessions by their cached balances, largest first"""
+        if gift_price <= 0:
+            return None
+        active = [s for s in session_manager.sessions if s["active"] and (s["balance"] or 0) > 0]
+        for use_reserved in (True, False):
+            shards = []
+            remaining = order_amount
+            for session in sorted(active, key=lambda s: self.free_balance(s, use_reserved), reverse=True):
+                count = min(remaining, int(self.free_balance(session, use_reserved) // gift_price))
+                if count <= 0:
+                    continue
+                shards.append((session, count))
+                remaining -= count
+                if remaining == 0:
+                    return shards
+        return None
+
+    def can_cover(self, gift_price, order_amount) -> bool:
+        """Whether dispatch() would place the order: on one session or, with split_orders, as whole gifts over several"""
+        if self.pick_session(order_amount * gift_price) is not None:
+            return True
+        return bool(get_setting("split_orders")) and self.plan_shards(gift_price, order_amount) is not None
+
+    def submit(self, c: Cardinal, data: Dict) -> concurrent.futures.Future:
+        future = runner.submit(self.dispatch(c, data))
+        future.add_done_callback(functools.partial(self._log_dispatch_error, data["order_id"]))
+        return future
+
+    @staticmethod
+    def _log_dispatch_error(order_id, future: concurrent.futures.Future):
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is not None:
+            logger.error(f"{LOGGER_PREFIX} Error dispatching order #{order_id}: {type(error).__name__}: {str(error)}")
+
+    async def dispatch(self, c: Cardinal, data: Dict):
+        order_amount = fulfilment.remaining(data)
+        gift_price = data["amount"]
+        if order_amount == 0:
+            logger.info("%s Order #%s: all gifts already sent, nothing to dispatch", LOGGER_PREFIX, data['order_id'])
+            await to_thread(report_order_result, c, data, True)
+            return
+        if order_amount < data["order_amount"]:
+            logger.info("%s Order #%s: resuming with %s/%s gifts left", LOGGER_PREFIX, data['order_id'], order_amount, data['order_amount'])
+        preferred = next((s for s in session_manager.sessions if s["name"] == data.get("session_name")), None)
+        session = self.pick_session(order_amount * gift_price, preferred)
+        shards = [(session, order_amount)] if session else None
+        if shards is None and get_setting("split_orders"):
+            shards = self.plan_shards(gift_price, order_amount)
+            if shards:
+                shard_list = ", ".join(f"{s['name']}:{count}" for s, count in shards)
+                logger.info("%s Order #%s split into %s shards (%s)", LOGGER_PREFIX, data['order_id'], len(shards), shard_list)
+        if shards is None:
+            await to_thread(report_order_result, c, data, False)
+            return
+
+        order_store.update(data["order_id"], session_name=", ".join(s["name"] for s, _ in shards))
+        tracker = {"pending": len(shards), "results": []}
+        for session, count in shards:
+            name = session["name"]
+            reserve = count * gift_price
+            self.reserved[name] = self.reserved.get(name, 0) + reserve
+            if name not in self.queues:
+                self.queues[name] = asyncio.Queue()
+            if name not in self.workers or self.workers[name].done():
+                self.workers[name] = asyncio.ensure_future(self.worker(session))
+            await self.queues[name].put((c, data, count, reserve, tracker))
+            logger.info("%s Order #%s: %s gifts queued on session %s (queue length: %s)", LOGGER_PREFIX, data['order_id'], count, name, self.queues[name].qsize())
+
+    async def worker(self, session):
+        name = session["name"]
+        jobs = self.queues[name]
+        while True:
+            c, data, count, reserve, tracker = await jobs.get()
+            self.busy[name] = self.busy.get(name, 0) + 1
+            error = None
+            try:
+                result = await buy_gifts(
+                    c, data["chat_id"], data["username"], data["gift_id"], count,
+                    data["order_id"], data["comment"], data["is_anonymous"], session=session
+                )
+                logger.debug("%s Gift sending result for order #%s on session %s: %s", LOGGER_PREFIX, data['order_id'], name, result)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                result = False
+                error = e
+            finally:
+                self.busy[name] -= 1
+                self.reserved[name] = max(self.reserved.get(name, 0) - reserve, 0)
+                jobs.task_done()
+            tracker["results"].append(result)
+            if error is not None:
+                tracker["error"] = error
+            if len(tracker["results"]) == tracker["pending"]:
+                try:
+                    await to_thread(report_order_result, c, data, all(tracker["results"]), tracker.get("error"))
+                except Exception as e:
+                    # Воркер обслуживает всю очередь сессии, поэтому ошибка одного отчёта не должна его останавливать
+                    logger.error(f"{LOGGER_PREFIX} Error reporting result of order #{data['order_id']} on session {name}: {type(e).__name__}: {str(e)}")
+
+dispatcher = OrderDispatcher()
 
 async def get_amount(gift_id):
-    session = await session_manager.get_active_session()
-    if not session:
+    with metrics.timer("get_amount", gift=gift_id):
+        gift = await gift_catalog.get(gift_id)
+    if gift is None:
+        logger.error(f"{LOGGER_PREFIX} Gift {gift_id} not found in catalog")
         return None
-    async with Client(session["name"], workdir=SESSIONS_PATH) as app:
-        try:
-            gifts = await app.get_available_gifts()
-            for gift in gifts:
-                if gift.id == gift_id:
-                    return gift.price
-            return None
-        except Exception as e:
-            logger.error(f"{LOGGER_PREFIX} Error getting gift amount for gift_id {gift_id}: {str(e)}")
-            return None
+    return gift["price"]
+
+LOT_MARKERS = ("ПОДАРОК НА АККАУНТ", "ПО USERNAME")
+LOT_KEY_RE = re.compile(r'🔮([^\s]+)[^\|]*\|')
+
+class LotMatcher:
+    """Aho-Corasick automaton over the key fragments of lot names, built once per config change"""
+    def __init__(self, mapping: Dict):
+        self.lots: List[Tuple[str, Dict, str]] = []
+        self.goto: List[Dict[str, int]] = [{}]
+        self.fail: List[int] = [0]
+        self.out: List[int | None] = [None]  # наименьший индекс лота, заканчивающегося в узле
+        for lot_key, lot_data in mapping.items():
+            key_part = LOT_KEY_RE.search(lot_data.get("name", ""))
+            if not key_part:
+                continue
+            self.lots.append((lot_key, lot_data, key_part.group(1)))
+            self._add(key_part.group(1), len(self.lots) - 1)
+        self._build()
+
+    def _add(self, pattern: str, idx: int):
+        node = 0
+        for ch in pattern:
+            nxt = self.goto[node].get(ch)
+            if nxt is None:
+                nxt = len(self.goto)
+                self.goto[node][ch] = nxt
+                self.goto.append({})
+                self.fail.append(0)
+                self.out.append(None)
+            node = nxt
+        if self.out[node] is None or idx < self.out[node]:
+            self.out[node] = idx
+
+    def _build(self):
+        order = [0]
+        for node in order:
+            for ch, nxt in self.goto[node].items():
+                order.append(nxt)
+                if node:
+                    f = self.fail[node]
+                    while f and ch not in self.goto[f]:
+                        f = self.fail[f]
+                    self.fail[nxt] = self.goto[f].get(ch, 0)
+                inherited = self.out[self.fail[nxt]]
+                if inherited is not None and (self.out[nxt] is None or inherited < self.out[nxt]):
+                    self.out[nxt] = inherited
+
+    def match(self, text: str) -> Tuple[str, Dict, str] | None:
+        """Return the first lot (in config order) whose key fragment occurs in text"""
+        best = None
+        node = 0
+        for ch in text:
+            while node and ch not in self.goto[node]:
+                node = self.fail[node]
+            node = self.goto[node].get(ch, 0)
+            found = self.out[node]
+            if found is not None and (best is None or found < best):
+                best = found
+                if best == 0:
+                    break
+        return self.lots[best] if best is not None else None
+
+lot_matcher = LotMatcher({})
+
+def set_lot_mapping(mapping: Dict):
+    """Replace the in-memory lot mapping and rebuild the matcher"""
+    global lot_matcher
+    lot_mapping.clear()
+    lot_mapping.update(mapping)
+    lot_matcher = LotMatcher(lot_mapping)
+    logger.debug("%s Lot matcher rebuilt: %s keys", LOGGER_PREFIX, len(lot_matcher.lots))
 
 def get_tg_id_by_description(description: str) -> Tuple[int | None, str | None]:
-    for lot_key, lot_data in lot_mapping.items():
-        lot_name = lot_data["name"]
-        if "ПОДАРОК НА АККАУНТ" not in description or "ПО USERNAME" not in description:
-            continue
-        key_part = re.search(r'🔮([^\s]+)[^\|]*\|', lot_name)
-        if key_part:
-            key_part = key_part.group(1)
-            if key_part in description:
-                gift_id = lot_data["gift_id"]
-                gift_name = lot_data["gift_name"]
-                logger.debug(f"{LOGGER_PREFIX} Lot found: {lot_name} (key: {key_part}) -> gift_id: {gift_id}, gift_name: {gift_name}")
-                return gift_id, gift_name
+    if not all(marker in description for marker in LOT_MARKERS):
+        logger.warning(f"{LOGGER_PREFIX} Lot not found for description: {description}")
+        return None, None
+    found = lot_matcher.match(description)
+    if found:
+        lot_key, lot_data, key_part = found
+        gift_id = lot_data["gift_id"]
+        gift_name = lot_data["gift_name"]
+        logger.debug("%s Lot found: %s (key: %s) -> gift_id: %s, gift_name: %s", LOGGER_PREFIX, lot_data['name'], key_part, gift_id, gift_name)
+        return gift_id, gift_name
     logger.warning(f"{LOGGER_PREFIX} Lot not found for description: {description}")
     return None, None
 
@@ -448,6 +1738,35 @@ def generate_lots_keyboard(page: int = 0) -> InlineKeyboardMarkup:
     kb.add(InlineKeyboardButton("🔙 Назад", callback_data="to_setting"))
     return kb
 
+_orders_lock = threading.Lock()
+_orders_ready = False
+
+def _prepare_orders_ledger():
+    """One-time migration of auto_gift_orders.json into the append-only JSONL ledger"""
+    global _orders_ready
+    if _orders_ready:
+        return
+    if os.path.exists(LEGACY_ORDERS_PATH):
+        if not os.path.exists(ORDERS_PATH):
+            with open(LEGACY_ORDERS_PATH, 'r', encoding='utf-8') as f:
+                legacy_orders = json.load(f)
+            tmp_path = ORDERS_PATH + ".tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                for order in legacy_orders:
+                    f.write(json.dumps(order, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, ORDERS_PATH)
+            logger.info("%s Migrated %s orders from %s to %s", LOGGER_PREFIX, len(legacy_orders), LEGACY_ORDERS_PATH, ORDERS_PATH)
+        os.replace(LEGACY_ORDERS_PATH, LEGACY_ORDERS_PATH + ".migrated")
+    if os.path.exists(ORDERS_PATH) and os.path.getsize(ORDERS_PATH) > 0:
+        # Недописанная при падении строка не должна склеиться со следующей записью
+        with open(ORDERS_PATH, 'rb+') as f:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                f.write(b"\n")
+    _orders_ready = True
+
 def save_order_info(order_id: int, order_summa: float, lot_name: str, order_profit: float):
     data_ = {
         "date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
@@ -456,37 +1775,174 @@ def save_order_info(order_id: int, order_summa: float, lot_name: str, order_prof
         "lot_name": lot_name,
         "profit": order_profit
     }
+    line = json.dumps(data_, ensure_ascii=False) + "\n"
+    with order_stats.lock:
+        with _orders_lock:
+            _prepare_orders_ledger()
+            with open(ORDERS_PATH, 'a', encoding='utf-8') as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+        if order_stats.loaded:
+            order_stats.add(data_)
+
+def load_orders():
+    """Iterate over recorded orders, skipping a torn last line"""
+    with _orders_lock:
+        _prepare_orders_ledger()
     if not os.path.exists(ORDERS_PATH):
-        with open(ORDERS_PATH, 'w', encoding='utf-8') as f:
-            json.dump([], f, indent=4, ensure_ascii=False)
-
+        return
     with open(ORDERS_PATH, 'r', encoding='utf-8') as f:
-        orders = json.load(f)
-    orders.append(data_)
-    with open(ORDERS_PATH, 'w', encoding='utf-8') as f:
-        json.dump(orders, f, indent=4, ensure_ascii=False)
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                logger.warning(f"{LOGGER_PREFIX} Skipping damaged order record: {line[:100]}")
 
 def fast_get_lot_fields(cardinal: Cardinal, lot_id: int):
-    return cardinal.account.get_lot_fields(lot_id)
+    with metrics.timer("get_lot_fields", lot=lot_id):
+        return cardinal.account.get_lot_fields(lot_id)
+
+def fast_save_lot(cardinal: Cardinal, lot_fields, lot_id: int | None = None):
+    with metrics.timer("save_lot", lot=lot_id):
+        cardinal.account.save_lot(lot_fields)
+
+def send_funpay_message(c: Cardinal, chat_id, text):
+    """c.send_message with latency and error accounting"""
+    with metrics.timer("send_message"):
+        return c.send_message(chat_id, text)
+
+class BlockingRateLimiter:
+    """Thread-safe pacing of FunPay requests shared by all lot workers"""
+    def __init__(self, rate: float):
+        self.lock = threading.Lock()
+        self.interval = 1 / rate
+        self.next_at = 0.0
+
+    def set_rate(self, rate: float):
+        with self.lock:
+            self.interval = 1 / rate
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            wait = self.next_at - now
+            self.next_at = max(now, self.next_at) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+funpay_limiter = BlockingRateLimiter(DEFAULT_SETTINGS["lot_rate"])
+
+class LotStateCache:
+    """Active flags of our lots per subcategory, kept in sync by our own writes and a periodic refresh"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.states: Dict[int, Dict[int, bool]] = {}
+        self.updated: Dict[int, float] = {}
+        self.fetch_locks: Dict[int, threading.Lock] = {}
+
+    def _fetch_lock(self, subcat_id: int) -> threading.Lock:
+        with self.lock:
+            return self.fetch_locks.setdefault(subcat_id, threading.Lock())
+
+    def refresh(self, cardinal: Cardinal, subcat_id: int) -> Dict[int, bool]:
+        funpay_limiter.acquire()
+        lots = get_my_subcategory_lots_fast(cardinal.account, subcat_id)
+        states = {lt.id: lt.active for lt in lots}
+        with self.lock:
+            self.states[subcat_id] = states
+            self.updated[subcat_id] = time.monotonic()
+        logger.debug("%s Lot states of subcat %s refreshed: %s/%s active", LOGGER_PREFIX, subcat_id, sum(states.values()), len(states))
+        return dict(states)
+
+    def get(self, cardinal: Cardinal, subcat_id: int, max_age: float = LOTS_TTL) -> Dict[int, bool]:
+        """Lot id -> active; one FunPay fetch at a time per subcategory, concurrent callers share it"""
+        requested = time.monotonic()
+        with self._fetch_lock(subcat_id):
+            with self.lock:
+                updated = self.updated.get(subcat_id)
+                if updated is not None and (updated >= requested or requested - updated <= max_age):
+                    return dict(self.states[subcat_id])
+            return self.refresh(cardinal, subcat_id)
+
+    def set_states(self, subcat_id: int, changes: Dict[int, bool]):
+        with self.lock:
+            if subcat_id in self.states:
+                self.states[subcat_id].update(changes)
+
+    async def refresh_loop(self, cardinal: Cardinal):
+        while True:
+            await asyncio.sleep(LOTS_TTL)
+            for subcat_id in list(self.states):
+                try:
+                    await to_thread(self.get, cardinal, subcat_id)
+                except Exception as e:
+                    logger.warning(f"{LOGGER_PREFIX} Lot state refresh for subcat {subcat_id} failed: {str(e)}")
 
-def fast_save_lot(cardinal: Cardinal, lot_fields):
-    cardinal.account.save_lot(lot_fields)
+lot_state = LotStateCache()
 
-def force_set_lot_active(cardinal: Cardinal, lot_id: int, make_active: bool) -> bool:
+def _set_lot_active(cardinal: Cardinal, lot_id: int, make_active: bool) -> str | None:
+    """Switch one lot, returns an error description or None"""
     try:
+        funpay_limiter.acquire()
         lf = fast_get_lot_fields(cardinal, lot_id)
     except Exception as e:
         logger.warning(f"{LOGGER_PREFIX} get_lot_fields(lot_id={lot_id}) error: {e}")
-        return False
-    time.sleep(0.3)
+        return f"get_lot_fields: {e}"
     lf.active = make_active
     lf.renew_fields()
     try:
-        fast_save_lot(cardinal, lf)
+        funpay_limiter.acquire()
+        fast_save_lot(cardinal, lf, lot_id)
     except Exception as e:
         logger.warning(f"{LOGGER_PREFIX} save_lot(lot_id={lot_id}) error: {e}")
-        return False
-    return True
+        return f"save_lot: {e}"
+    return None
+
+def set_subcat_active(cardinal: Cardinal, subcat_id: str, make_active: bool, states: Dict[int, bool] | None = None) -> Dict:
+    """Bring every lot of the subcategory to make_active, touching only lots in the other state"""
+    funpay_limiter.set_rate(get_setting("lot_rate"))
+    report = {"target": make_active, "changed": [], "skipped": [], "failed": {}}
+    try:
+        sc_id = int(subcat_id)
+    except (TypeError, ValueError):
+        report["failed"][subcat_id] = "invalid subcategory id"
+        return report
+    if states is None:
+        try:
+            states = lot_state.get(cardinal, sc_id)
+        except Exception as e:
+            logger.warning(f"{LOGGER_PREFIX} get_my_subcategory_lots({subcat_id}) error: {e}")
+            report["failed"][subcat_id] = str(e)
+            return report
+
+    pending = []
+    for lot_id, active in states.items():
+        if active == make_active:
+            report["skipped"].append(lot_id)
+        else:
+            pending.append(lot_id)
+    if pending:
+        workers = max(1, min(get_setting("lot_workers"), len(pending)))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="auto-gifts-lots") as pool:
+            futures = {pool.submit(_set_lot_active, cardinal, lot_id, make_active): lot_id for lot_id in pending}
+            for future in concurrent.futures.as_completed(futures):
+                lot_id = futures[future]
+                error = future.result()
+                if error is None:
+                    report["changed"].append(lot_id)
+                else:
+                    report["failed"][lot_id] = error
+        lot_state.set_states(sc_id, {lot_id: make_active for lot_id in report["changed"]})
+
+    logger.info(
+        "%s subcat=%s => %s: changed=%s, skipped=%s, failed=%s", LOGGER_PREFIX, subcat_id, make_active,
+        len(report["changed"]), len(report["skipped"]), len(report["failed"])
+    )
+    return report
 
 def get_my_subcategory_lots_fast(account, subcat_id: int):
     return account.get_my_subcategory_lots(subcat_id)
@@ -497,27 +1953,16 @@ def clean_display_name(name: str) -> str:
     name = re.sub(r'[|[\]<>]', '', name)
     name = name.replace('*', '\\*').replace('_', '\\_').replace('`', '\\`')
     return name.strip()[:100] 
-def toggle_subcat_status(cardinal: Cardinal, subcat_id: str) -> bool:
-    old_st = is_subcat_active(cardinal, subcat_id)
-    new_st = not old_st
-    try:
-        sc_id = int(subcat_id)
-    except:
-        return new_st
-
-    changed = 0
+def toggle_subcat_status(cardinal: Cardinal, subcat_id: str) -> Dict:
+    """Flip the subcategory: deactivate if any lot is active, otherwise activate all"""
     try:
-        sub_lots = get_my_subcategory_lots_fast(cardinal.account, sc_id)
+        # Ручное переключение из панели: читаем актуальное состояние, а не кэш
+        states = lot_state.get(cardinal, int(subcat_id), max_age=0)
     except Exception as e:
         logger.warning(f"{LOGGER_PREFIX} get_my_subcategory_lots({subcat_id}) error: {e}")
-        return new_st
-
-    for lt in sub_lots:
-        if force_set_lot_active(cardinal, lt.id, new_st):
-            changed += 1
-
-    logger.info(f"{LOGGER_PREFIX} subcat={subcat_id} => {new_st}, changed={changed}.")
-    return new_st
+        return {"target": not get_setting("active_lots"), "changed": [], "skipped": [], "failed": {subcat_id: str(e)}}
+    new_st = not any(states.values())
+    return set_subcat_active(cardinal, subcat_id, new_st, states)
 
 def is_subcat_active(cardinal: Cardinal, subcat_id: str) -> bool:
     try:
@@ -525,65 +1970,117 @@ def is_subcat_active(cardinal: Cardinal, subcat_id: str) -> bool:
     except:
         return False
     try:
-        lots = get_my_subcategory_lots_fast(cardinal.account, sc_id)
-        if not lots:
-            return False
-        return any(l.active for l in lots)
+        return any(lot_state.get(cardinal, sc_id).values())
     except:
         logger.warning(f"{LOGGER_PREFIX} is_subcat_active({subcat_id}): error => returning False")
         return False
 
+STATS_WINDOW_DAYS = 30
+
+class OrderStats:
+    """Hourly buckets of order count, sum, profit and per-lot frequency, filled once from the ledger;
+    each bucket also keeps its orders with exact times for the partial hour at a window boundary"""
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.buckets: Dict[int, Dict] = {}
+        self.total = self._empty()
+        self.loaded = False
+
+    @staticmethod
+    def _empty() -> Dict:
+        return {"count": 0, "summa": 0.0, "profit": 0.0, "lots": {}}
+
+    @staticmethod
+    def _hour(moment: datetime) -> int:
+        return int(moment.timestamp()) // 3600
+
+    @staticmethod
+    def _merge(target: Dict, bucket: Dict):
+        target["count"] += bucket["count"]
+        target["summa"] += bucket["summa"]
+        target["profit"] += bucket["profit"]
+        for lot_name, count in bucket["lots"].items():
+            target["lots"][lot_name] = target["lots"].get(lot_name, 0) + count
+
+    def add(self, order: Dict):
+        moment = datetime.strptime(order["date"], "%Y-%m-%d %H:%M:%S")
+        hour = self._hour(moment)
+        single = {
+            "count": 1,
+            "summa": order["summa"],
+            "profit": order.get("profit", 0),
+            "lots": {order.get("lot_name", "Неизвестно"): 1},
+        }
+        self._merge(self.total, single)
+        oldest = self._hour(datetime.now() - timedelta(days=STATS_WINDOW_DAYS)) - 1
+        if hour >= oldest:
+            bucket = self.buckets.get(hour)
+            if bucket is None:
+                bucket = self.buckets[hour] = dict(self._empty(), orders=[])
+            self._merge(bucket, single)
+            bucket["orders"].append((moment.timestamp(), single))
+        for stale in [h for h in self.buckets if h < oldest]:
+            del self.buckets[stale]
+
+    def ensure_loaded(self):
+        with self.lock:
+            if self.loaded:
+                return
+            for order in load_orders():
+                self.add(order)
+            self.loaded = True
+            logger.info("%s Order statistics built: %s orders", LOGGER_PREFIX, self.total['count'])
+
+    def window(self, since: datetime) -> Dict:
+        """Orders placed at or after since: whole hours from the aggregates, the boundary hour order by order"""
+        result = self._empty()
+        cutoff = since.timestamp()
+        first_hour = self._hour(since)
+        for hour, bucket in self.buckets.items():
+            if hour > first_hour:
+                self._merge(result, bucket)
+            elif hour == first_hour:
+                for moment, single in bucket["orders"]:
+                    if moment >= cutoff:
+                        self._merge(result, single)
+        return result
+
+order_stats = OrderStats()
+
 def get_statistics():
-    if not os.path.exists(ORDERS_PATH):
-        return None
-    with open(ORDERS_PATH, 'r', encoding='utf-8') as f:
-        orders = json.load(f)
-    now = datetime.now()
-    day_ago = now - timedelta(days=1)
-    week_ago = now - timedelta(days=7)
-    month_ago = now - timedelta(days=30)
-
-    day_orders = [o for o in orders if datetime.strptime(o["date"], "%Y-%m-%d %H:%M:%S") >= day_ago]
-    week_orders = [o for o in orders if datetime.strptime(o["date"], "%Y-%m-%d %H:%M:%S") >= week_ago]
-    month_orders = [o for o in orders if datetime.strptime(o["date"], "%Y-%m-%d %H:%M:%S") >= month_ago]
-    all_orders = orders
-
-    day_total = round(sum(o["summa"] for o in day_orders), 2)
-    week_total = round(sum(o["summa"] for o in week_orders), 2)
-    month_total = round(sum(o["summa"] for o in month_orders), 2)
-    all_total = round(sum(o["summa"] for o in all_orders), 2)
-
-    day_profit = round(sum(o.get("profit", 0) for o in day_orders), 2)
-    week_profit = round(sum(o.get("profit", 0) for o in week_orders), 2)
-    month_profit = round(sum(o.get("profit", 0) for o in month_orders), 2)
-    all_profit = round(sum(o.get("profit", 0) for o in all_orders), 2)
-
-    def find_best_service(os_):
-        if not os_:
+    with order_stats.lock:
+        order_stats.ensure_loaded()
+        if not order_stats.total["count"]:
+            return None
+        now = datetime.now()
+        day = order_stats.window(now - timedelta(days=1))
+        week = order_stats.window(now - timedelta(days=7))
+        month = order_stats.window(now - timedelta(days=STATS_WINDOW_DAYS))
+        all_time = order_stats._empty()
+        order_stats._merge(all_time, order_stats.total)
+
+    def find_best_service(agg):
+        if not agg["lots"]:
             return "Нет"
-        freq = {}
-        for _o in os_:
-            srv = _o.get("lot_name", "Неизвестно")
-            freq[srv] = freq.get(srv, 0) + 1
-        return max(freq, key=freq.get, default="Нет")
+        return max(agg["lots"], key=agg["lots"].get, default="Нет")
 
     return {
-        "day_orders": len(day_orders),
-        "day_total": day_total,
-        "day_profit": day_profit,
-        "week_orders": len(week_orders),
-        "week_total": week_total,
-        "week_profit": week_profit,
-        "month_orders": len(month_orders),
-        "month_total": month_total,
-        "month_profit": month_profit,
-        "all_time_orders": len(all_orders),
-        "all_time_total": all_total,
-        "all_time_profit": all_profit,
-        "best_day_service": find_best_service(day_orders),
-        "best_week_service": find_best_service(week_orders),
-        "best_month_service": find_best_service(month_orders),
-        "best_all_time_service": find_best_service(all_orders),
+        "day_orders": day["count"],
+        "day_total": round(day["summa"], 2),
+        "day_profit": round(day["profit"], 2),
+        "week_orders": week["count"],
+        "week_total": round(week["summa"], 2),
+        "week_profit": round(week["profit"], 2),
+        "month_orders": month["count"],
+        "month_total": round(month["summa"], 2),
+        "month_profit": round(month["profit"], 2),
+        "all_time_orders": all_time["count"],
+        "all_time_total": round(all_time["summa"], 2),
+        "all_time_profit": round(all_time["profit"], 2),
+        "best_day_service": find_best_service(day),
+        "best_week_service": find_best_service(week),
+        "best_month_service": find_best_service(month),
+        "best_all_time_service": find_best_service(all_time),
     }
 
 def reindex_lots(cfg: Dict):
@@ -598,28 +2095,303 @@ def reindex_lots(cfg: Dict):
         new_lot_map[new_key] = lot_data
     cfg["lot_mapping"] = new_lot_map
     save_config(cfg)
-    logger.info(f"{LOGGER_PREFIX} Lots reindexed after deletion")
+    logger.info("%s Lots reindexed after deletion", LOGGER_PREFIX)
+
+class LotWizard:
+    """Add-lot conversation per admin chat: lot ID -> GIFT ID -> GIFT Name, one config write at the end"""
+    def __init__(self, c: Cardinal, bot):
+        self.c = c
+        self.bot = bot
+        self.lock = threading.Lock()
+        self.chats: Dict[int, Dict] = {}
+
+    @staticmethod
+    def cancel_keyboard() -> InlineKeyboardMarkup:
+        kb = InlineKeyboardMarkup()
+        kb.add(InlineKeyboardButton("❌ Отменить", callback_data="add_lot_cancel"))
+        return kb
+
+    def _ask(self, chat_id, text, handler):
+        msg = self.bot.send_message(chat_id, text, parse_mode="HTML", reply_markup=self.cancel_keyboard())
+        self.bot.register_next_step_handler(msg, handler)
+
+    def _arm_timer(self, chat_id, state: Dict):
+        """(Re)start the inactivity timeout on the background loop; a stale timer is ignored by its token"""
+        token = object()
+        state["token"] = token
+
+        def arm():
+            self._cancel_timer(state)
+            state["timer"] = runner.loop.call_later(
+                LOT_WIZARD_TIMEOUT, lambda: runner.loop.run_in_executor(None, self.expire, chat_id, token)
+            )
+
+        runner.submit_callback(arm)
+
+    @staticmethod
+    def _cancel_timer(state: Dict):
+        if state.get("timer") is not None:
+            state["timer"].cancel()
+            state["timer"] = None
+
+    def _finish(self, chat_id) -> Dict | None:
+        with self.lock:
+            state = self.chats.pop(chat_id, None)
+        if state is None:
+            return None
+        state["token"] = None
+        runner.submit_callback(self._cancel_timer, state)
+        self.bot.clear_step_handler_by_chat_id(chat_id)
+        return state
+
+    def start(self, chat_id):
+        self._finish(chat_id)
+        state = {"step": "lot_id"}
+        with self.lock:
+            self.chats[chat_id] = state
+        self._arm_timer(chat_id, state)
+        self._ask(chat_id, "📦 Давай добавим новый лот!\n🔢 Введи <b>ID лота</b>, который хочешь добавить:", self.on_lot_id)
+
+    def cancel(self, chat_id, silent=False):
+        if self._finish(chat_id) is None or silent:
+            return
+        kb = InlineKeyboardMarkup()
+        kb.add(InlineKeyboardButton("⚙️ К настройкам", callback_data="to_setting"))
+        self.bot.send_message(chat_id, "🚫 Добавление лота отменено", reply_markup=kb)
+
+    def expire(self, chat_id, token):
+        state = self.chats.get(chat_id)
+        if state is None or state.get("token") is not token:
+            return
+        self._finish(chat_id)
+        logger.info("%s Add-lot wizard in chat %s timed out", LOGGER_PREFIX, chat_id)
+        self.bot.send_message(chat_id, "⌛ Время на добавление лота истекло. Начни заново из настроек.")
+
+    def _state(self, message: types.Message, step: str) -> Dict | None:
+        state = self.chats.get(message.chat.id)
+        if state is None or state["step"] != step:
+            return None
+        self._arm_timer(message.chat.id, state)
+        return state
+
+    def on_lot_id(self, message: types.Message):
+        state = self._state(message, "lot_id")
+        if state is None:
+            return
+        try:
+            lot_id = int((message.text or "").strip())
+        except ValueError:
+            self._ask(message.chat.id, "🚫 Oшибочка! ID лота должен быть числом 🔢\nПопробуй ещё раз 👇", self.on_lot_id)
+            return
+        try:
+            lot_fields = fast_get_lot_fields(self.c, lot_id)
+            name = lot_fields.fields.get("fields[summary][ru]", "Без названия")
+        except Exception as e:
+            self._ask(
+                message.chat.id,
+                f"❌ Упс! Не удалось получить данные лота 😔\nОшибка: <code>{e}</code>\nВведи другой ID лота 👇",
+                self.on_lot_id
+            )
+            return
+        state.update(step="gift_id", name=name)
+        self._ask(message.chat.id, "📦 Введи GIFT ID для добавления 🎁\n(только цифры, пожалуйста!)", self.on_gift_id)
+
+    def on_gift_id(self, message: types.Message):
+        state = self._state(message, "gift_id")
+        if state is None:
+            return
+        try:
+            gift_id = int((message.text or "").strip())
+        except ValueError:
+            self._ask(message.chat.id, "🚫 GIFT ID должен быть числом! 🔢\nПопробуй ещё раз — всё получится 💪", self.on_gift_id)
+            return
+        state.update(step="gift_name", gift_id=gift_id)
+        self._ask(message.chat.id, "🏷 Введи GIFT Name для добавления 🎁\nКак назовём этот подарок?", self.on_gift_name)
+
+    def on_gift_name(self, message: types.Message):
+        state = self._state(message, "gift_name")
+        if state is None:
+            return
+        gift_name = (message.text or "").strip()
+        if not gift_name:
+            self._ask(message.chat.id, "🏷 Название не может быть пустым, попробуй ещё раз 👇", self.on_gift_name)
+            return
+        if self._finish(message.chat.id) is None:
+            return
+        cfg = load_config()
+        lot_map = cfg.setdefault("lot_mapping", {})
+        new_lot_key = f"lot_{len(lot_map) + 1}"
+        lot_map[new_lot_key] = {
+            "name": state["name"],
+            "gift_id": state["gift_id"],
+            "gift_name": gift_name
+        }
+        save_config(cfg)
+        logger.info("%s Lot %s added: %s -> gift_id %s", LOGGER_PREFIX, new_lot_key, state['name'], state['gift_id'])
+        kb = InlineKeyboardMarkup()
+        kb.add(InlineKeyboardButton("⚙️ К настройкам", callback_data="to_setting"))
+        self.bot.send_message(
+            message.chat.id,
+            f"✅ Лот <b>{new_lot_key}</b> успешно добавлен! 🎉\nНазвание: <b>{state['name']}</b>",
+            parse_mode="HTML",
+            reply_markup=kb
+        )
+
+class LiveMessages:
+    """Bot messages drawn from cached state at once and edited in place when a background refresh finishes"""
+    def __init__(self, bot):
+        self.bot = bot
+        self.lock = threading.Lock()
+        self.views: Dict[Tuple[int, int], object] = {}
+
+    def show(self, chat_id, render, refresh=None, message_id=None):
+        text, kb = render()
+        if message_id is None:
+            message_id = self.bot.send_message(chat_id, text, parse_mode='HTML', reply_markup=kb).message_id
+        else:
+            self.bot.edit_message_text(text, chat_id, message_id, parse_mode='HTML', reply_markup=kb)
+        if refresh is None:
+            return
+        token = object()
+        with self.lock:
+            self.views[(chat_id, message_id)] = token
+        runner.submit(self._refresh(chat_id, message_id, token, text, render, refresh))
+
+    def forget(self, chat_id, message_id):
+        """The message now shows something else, a pending refresh must not overwrite it"""
+        with self.lock:
+            self.views.pop((chat_id, message_id), None)
+
+    async def _refresh(self, chat_id, message_id, token, text, render, refresh):
+        try:
+            await refresh()
+        except Exception as e:
+            logger.warning(f"{LOGGER_PREFIX} Background refresh for message {message_id} failed: {str(e)}")
+        with self.lock:
+            if self.views.get((chat_id, message_id)) is not token:
+                return
+            del self.views[(chat_id, message_id)]
+        new_text, kb = render()
+        if new_text == text:
+            return
+        try:
+            await to_thread(self.bot.edit_message_text, new_text, chat_id, message_id, parse_mode='HTML', reply_markup=kb)
+        except Exception as e:
+            logger.debug("%s Could not update message %s: %s", LOGGER_PREFIX, message_id, e)
+
+def resume_pending_orders(c: Cardinal):
+    """Pick up conversations that were pending when the plugin stopped"""
+    for data in list(order_store.orders.values()):
+        if data["step"] != "sending":
+            continue
+        sent = fulfilment.sent_count(data["order_id"])
+        try:
+            # Журнал выдачи знает, сколько подарков уже ушло, поэтому досылаем остаток без участия покупателя
+            logger.info("%s Re-dispatching interrupted order #%s (%s/%s gifts already sent)", LOGGER_PREFIX, data['order_id'], sent, data['order_amount'])
+            dispatcher.submit(c, data)
+        except Exception as e:
+            logger.error(f"{LOGGER_PREFIX} Error resuming order #{data['order_id']}: {str(e)}")
+    if order_store.orders:
+        logger.info("%s Resumed %s pending orders", LOGGER_PREFIX, len(order_store.orders))
+
+class WarmUp:
+    """Session warm-up on the background loop; hooks that fire before it finishes are replayed afterwards"""
+    def __init__(self):
+        self.state = "pending"  # pending -> warming -> ready
+        self.ready = threading.Event()
+        self.lock = threading.Lock()
+        self.deferred: List[Tuple] = []
+        self.replaying = threading.local()
+
+    def start(self, c: Cardinal):
+        with self.lock:
+            if self.state != "pending":
+                return
+            self.state = "warming"
+        runner.submit(self.run(c))
+
+    async def run(self, c: Cardinal):
+        started = time.monotonic()
+        try:
+            await inform()
+        except Exception as e:
+            logger.error(f"{LOGGER_PREFIX} Session warm-up failed: {type(e).__name__}: {str(e)}")
+        try:
+            await gift_catalog.refresh()
+        except Exception as e:
+            logger.error(f"{LOGGER_PREFIX} Gift catalog warm-up failed: {type(e).__name__}: {str(e)}")
+        asyncio.ensure_future(session_manager.health_check_loop())
+        asyncio.ensure_future(session_manager.balance_refresh_loop())
+        asyncio.ensure_future(gift_catalog.refresh_loop())
+        asyncio.ensure_future(session_manager.stats_flush_loop())
+        asyncio.ensure_future(lot_state.refresh_loop(c))
+        if get_setting("metrics_interval") > 0:
+            asyncio.ensure_future(metrics.write_loop())
+        if get_setting("metrics_port"):
+            try:
+                metrics.serve(int(get_setting("metrics_port")))
+            except OSError as e:
+                logger.error(f"{LOGGER_PREFIX} Metrics endpoint failed to start: {str(e)}")
+        await to_thread(resume_pending_orders, c)
+        while True:
+            with self.lock:
+                batch, self.deferred = self.deferred, []
+                if not batch:
+                    self.state = "ready"
+                    self.ready.set()
+                    break
+            logger.info("%s Replaying %s events received during warm-up", LOGGER_PREFIX, len(batch))
+            for hook, hook_c, event in batch:
+                try:
+                    await to_thread(self._replay, hook, hook_c, event)
+                except Exception as e:
+                    logger.error(f"{LOGGER_PREFIX} Error replaying {hook.__name__}: {type(e).__name__}: {str(e)}")
+        logger.info("%s Warm-up finished in %.1fs", LOGGER_PREFIX, time.monotonic() - started)
+
+    def _replay(self, hook, c: Cardinal, event):
+        self.replaying.active = True
+        try:
+            hook(c, event)
+        finally:
+            self.replaying.active = False
+
+    def defer(self, hook, c: Cardinal, event) -> bool:
+        """Queue the event if warm-up is still running; False means the hook should handle it now"""
+        if self.ready.is_set() or getattr(self.replaying, "active", False):
+            return False
+        with self.lock:
+            if self.state == "ready":
+                return False
+            self.deferred.append((hook, c, event))
+        return True
+
+warmup = WarmUp()
 
 def init_commands(c: Cardinal):
     global config, lot_mapping
-    logger.info(f"{LOGGER_PREFIX} === init_commands() from auto_gifts ===")
+    log_pipeline.configure(get_setting("log_level"), get_setting("log_json"))
+    logger.info("%s === init_commands() from auto_gifts ===", LOGGER_PREFIX)
+    warmup.start(c)
     if not c.telegram:
         return
     bot = c.telegram.bot
+    notifier.start(bot)
+    lot_wizard = LotWizard(c, bot)
+    live_messages = LiveMessages(bot)
     global RUNNING
     RUNNING = True
-    logger.info(f"{LOGGER_PREFIX} Auto Gifts plugin automatically activated")
+    logger.info("%s Auto Gifts plugin automatically activated", LOGGER_PREFIX)
 
     @bot.message_handler(content_types=['document'])
     def handle_document_upload(message: types.Message):
         user_id = message.from_user.id
-        logger.info(f"{LOGGER_PREFIX} Received document from {user_id}. Checking waitlist...")
+        logger.info("%s Received document from %s. Checking waitlist...", LOGGER_PREFIX, user_id)
         if user_id not in waiting_for_lots_upload:
-            logger.info(f"{LOGGER_PREFIX} User {user_id} not waiting for JSON upload")
+            logger.info("%s User %s not waiting for JSON upload", LOGGER_PREFIX, user_id)
             bot.send_message(message.chat.id, "❌ Вы не активировали загрузку JSON. Используйте меню настроек.")
             return
         waiting_for_lots_upload.remove(user_id)
-        logger.info(f"{LOGGER_PREFIX} User {user_id} removed from waitlist. Processing file...")
+        logger.info("%s User %s removed from waitlist. Processing file...", LOGGER_PREFIX, user_id)
         file_id = message.document.file_id
         file_info = bot.get_file(file_id)
         downloaded_file = bot.download_file(file_info.file_path)
@@ -633,7 +2405,7 @@ def init_commands(c: Cardinal):
             kb_ = InlineKeyboardMarkup()
             kb_.add(InlineKeyboardButton("🔙 Назад", callback_data="to_setting"))
             bot.send_message(message.chat.id, "✅ Новый gift_lots.json успешно загружен и сохранён!", reply_markup=kb_)
-            logger.info(f"{LOGGER_PREFIX} JSON successfully uploaded and saved")
+            logger.info("%s JSON successfully uploaded and saved", LOGGER_PREFIX)
         except json.JSONDecodeError as e:
             bot.send_message(message.chat.id, f"❌ Ошибка: Не удалось считать JSON. Проверьте синтаксис. ({e})")
             logger.error(f"{LOGGER_PREFIX} JSON decode error: {e}")
@@ -658,8 +2430,7 @@ def init_commands(c: Cardinal):
         RUNNING = False
     cfg = load_config()
     config.update(cfg)
-    lot_mapping.clear()
-    lot_mapping.update(cfg.get("lot_mapping", {}))
+    set_lot_mapping(cfg.get("lot_mapping", {}))
 
     def edit_lot(call: types.CallbackQuery, lot_key: str):
         cfg = load_config()
@@ -707,108 +2478,6 @@ GIFT NAME: <code>{ld['gift_name']}</code>
             reply_markup=kb_
         )
 
-    def process_new_lot(message: types.Message):
-        try:
-            lot_id = int(message.text.strip())
-        except ValueError:
-            kb = InlineKeyboardMarkup()
-            kb.add(InlineKeyboardButton("🔙 Назад", callback_data="to_setting"))
-            bot.send_message(
-                message.chat.id,
-                "🚫 Oшибочка! ID лота должен быть числом 🔢\nПопробуй ещё раз 👇",
-                reply_markup=kb
-            )
-            return
-
-        try:
-            lot_fields = c.account.get_lot_fields(lot_id)
-            fields = lot_fields.fields
-            name = fields.get("fields[summary][ru]", "Без названия")
-        except Exception as e:
-            kb = InlineKeyboardMarkup()
-            kb.add(InlineKeyboardButton("🔙 Назад", callback_data="to_setting"))
-            bot.send_message(
-                message.chat.id,
-                f"❌ Упс! Не удалось получить данные лота 😔\nОшибка: <code>{e}</code>",
-                parse_mode="HTML",
-                reply_markup=kb
-            )
-            return
-
-        cfg = load_config()
-        lot_map = cfg.get("lot_mapping", {})
-
-        new_lot_key = f"lot_{len(lot_map) + 1}"
-
-        lot_map[new_lot_key] = {
-            "name": name,
-            "gift_id": 1,
-            "gift_name": ""
-        }
-
-        cfg["lot_mapping"] = lot_map
-        save_config(cfg)
-
-        def process_new_lot2(message: types.Message):
-            try:
-                gift_id = int(message.text.strip())
-            except ValueError:
-                kb = InlineKeyboardMarkup()
-                kb.add(InlineKeyboardButton("🔙 Назад", callback_data="to_setting"))
-                bot.send_message(
-                    message.chat.id,
-                    "🚫 GIFT ID должен быть числом! 🔢\nПопробуй ещё раз — всё получится 💪",
-                    reply_markup=kb
-                )
-                return
-
-            lot_map[new_lot_key]["gift_id"] = gift_id
-            cfg["lot_mapping"] = lot_map
-            save_config(cfg)
-
-        msg = bot.send_message(
-            message.chat.id,
-            "📦 Введи GIFT ID для добавления 🎁\n(только цифры, пожалуйста!)"
-        )
-        bot.register_next_step_handler(msg, process_new_lot2)
-
-        while True:
-            cfg = load_config()
-            lot_map = cfg.get("lot_mapping", {})
-            if lot_map[new_lot_key]['gift_id'] == 1:
-                time.sleep(2)
-            else:
-                break
-
-        def process_new_lot3(message: types.Message):
-            gift_name = message.text.strip()
-            lot_map[new_lot_key]["gift_name"] = gift_name
-            cfg["lot_mapping"] = lot_map
-            save_config(cfg)
-
-        msg = bot.send_message(
-            message.chat.id,
-            "🏷 Введи GIFT Name для добавления 🎁\nКак назовём этот подарок?"
-        )
-        bot.register_next_step_handler(msg, process_new_lot3)
-
-        while True:
-            cfg = load_config()
-            lot_map = cfg.get("lot_mapping", {})
-            if lot_map[new_lot_key]['gift_name'] == "":
-                time.sleep(2)
-            else:
-                break
-
-        kb = InlineKeyboardMarkup()
-        kb.add(InlineKeyboardButton("⚙️ К настройкам", callback_data="to_setting"))
-        bot.send_message(
-            message.chat.id,
-            f"✅ Лот <b>{new_lot_key}</b> успешно добавлен! 🎉\nНазвание: <b>{name}</b>",
-            parse_mode="HTML",
-            reply_markup=kb
-        )
-
     def process_id_change(message: types.Message, lot_key: str):
         try:
             new_id = int(message.text.strip())
@@ -894,26 +2563,26 @@ GIFT NAME: <code>{ld['gift_name']}</code>
                 parse_mode="HTML"
             )
 
-    def auto_gifts_settings(message: types.Message):
+    def render_settings(title: str, add_label: str):
         cfg = load_config()
         lmap = cfg.get("lot_mapping", {})
         auto_refunds = cfg.get("auto_refunds", True)
         active_lots = cfg.get("active_lots", True)
 
-        loop = asyncio.new_event_loop()
-        try:
-            stars = loop.run_until_complete(get_balance())
-        finally:
-            loop.close()
+        active_session = session_manager.peek_active_session()
+        stars = active_session["balance"] if active_session else 0
+        updated = session_manager.balances_updated
+        updated_text = updated.strftime("%H:%M:%S") if updated else "ещё не обновлялись"
 
         txt = f"""
-    <b>⚙️ Auto Gifts v{VERSION} — панель управления</b>
-👨‍💻 Разработчик: {CREDITS}
+    {title}
+👨‍💻 <b>Разработчик:</b> {CREDITS}
 
-📦 <b>Всего лотов:</b> {len(lmap)}
+📦 <b>Лотов в системе:</b> {len(lmap)}
 🌟 <b>Баланс звёзд (активная сессия):</b> {stars}
 📝 <b>Описание:</b> {DESCRIPTION}
 📡 <b>Активных сессий:</b> {sum(1 for s in session_manager.sessions if s['active'])}/{len(session_manager.sessions)}
+🕒 <b>Балансы обновлены:</b> {updated_text}
     """.strip()
 
         kb = InlineKeyboardMarkup(row_width=2)
@@ -926,79 +2595,71 @@ GIFT NAME: <code>{ld['gift_name']}</code>
             InlineKeyboardButton(
                 f"{'🟢' if active_lots else '🔴'} Лоты активны", callback_data="active_lot"
             ),
-            InlineKeyboardButton("➕ Новый лот", callback_data="add_lot"),
+            InlineKeyboardButton(add_label, callback_data="add_lot"),
             InlineKeyboardButton("📊 Статистика", callback_data="show_stat"),
             InlineKeyboardButton("📡 Статус сессий", callback_data="show_sessions")  # New button
         )
+        return txt, kb
 
-        bot.send_message(message.chat.id, txt, parse_mode='HTML', reply_markup=kb)
+    async def refresh_balances():
+        """Background balance sweep for the panel, skipped while the cache is fresh"""
+        updated = session_manager.balances_updated
+        if updated is None or datetime.now() - updated > timedelta(seconds=PANEL_FRESH_AGE):
+            await session_manager.schedule_refresh()
+
+    def auto_gifts_settings(message: types.Message):
+        render = functools.partial(render_settings, f"<b>⚙️ Auto Gifts v{VERSION} — панель управления</b>", "➕ Новый лот")
+        live_messages.show(message.chat.id, render, refresh_balances)
 
     @bot.callback_query_handler(func=lambda call: call.data == "show_sessions")
     def show_sessions(call: types.CallbackQuery):
-        loop = asyncio.new_event_loop()
-        try:
-            # Update balances for all sessions
-            for session in session_manager.sessions:
-                async def update_balance(s):
-                    async with Client(s["name"], workdir=SESSIONS_PATH) as app:
-                        try:
-                            balance = await app.get_stars_balance()
-                            s["balance"] = balance
-                            if balance == 0 and s["active"]:
-                                s["active"] = False
-                                await session_manager.notify_low_balance(s, bot, get_authorized_users())
-                            elif balance > 0 and not s["active"]:
-                                s["active"] = True
-                        except Exception as e:
-                            logger.error(f"{LOGGER_PREFIX} Error updating balance for session {s['name']}: {str(e)}")
-                            s["active"] = False
-                loop.run_until_complete(update_balance(session))
-            active_session = loop.run_until_complete(session_manager.get_active_session())
-            active_session_name = active_session["name"] if active_session else "Нет активной сессии"
-
-            # Format the session status message
-            text = "<b>📡 Статус сессий</b>\n\n"
-            for session in session_manager.sessions:
-                status = "🟢 Активна" if session["active"] else "🔴 Неактивна"
-                is_current = " (Текущая)" if session["name"] == active_session_name else ""
-                balance = session.get("balance", 0)
-                gifts_sent = session.get("gifts_sent", 0)
-                total_cost = session.get("total_cost", 0.0)
-                text += (
-                    f"📌 <b>{session['name']}{is_current}</b>\n"
-                    f"   {status}\n"
-                    f"   🌟 Баланс: {balance} звёзд\n"
-                    f"   🎁 Подарков отправлено: {gifts_sent}\n"
-                    f"   💸 Общая стоимость: {total_cost} звёзд\n\n"
-                )
-
-            kb = InlineKeyboardMarkup()
-            kb.add(InlineKeyboardButton("🔙 Вернуться в настройки", callback_data="to_setting"))
-            bot.edit_message_text(
-                text,
-                call.message.chat.id,
-                call.message.message_id,
-                parse_mode='HTML',
-                reply_markup=kb
+        live_messages.show(call.message.chat.id, render_sessions, refresh_sessions, call.message.message_id)
+
+    async def refresh_sessions():
+        """Status panel sweep; joins a refresh that is already running instead of starting another"""
+        await session_manager.schedule_refresh()
+
+    def render_sessions():
+        active_session = session_manager.peek_active_session()
+        active_session_name = active_session["name"] if active_session else "Нет активной сессии"
+        updated = session_manager.balances_updated
+
+        # Format the session status message
+        text = "<b>📡 Статус сессий</b>\n\n"
+        text += f"🕒 Обновлено: {updated.strftime('%H:%M:%S') if updated else 'ещё не проверялись'}\n\n"
+        if not warmup.ready.is_set():
+            text += "⏳ Сессии ещё подключаются, заказы ставятся в очередь\n\n"
+        for session in session_manager.sessions:
+            status = "🟢 Активна" if session["active"] else "🔴 Неактивна"
+            is_current = " (Текущая)" if session["name"] == active_session_name else ""
+            balance = session.get("balance", 0)
+            gifts_sent = session.get("gifts_sent", 0)
+            total_cost = session.get("total_cost", 0.0)
+            rate = session_manager.send_rate(session)
+            text += (
+                f"📌 <b>{session['name']}{is_current}</b>\n"
+                f"   {status}\n"
+                f"   🌟 Баланс: {balance} звёзд\n"
+                f"   🎁 Подарков отправлено: {gifts_sent}\n"
+                f"   💸 Общая стоимость: {total_cost} звёзд\n"
+                f"   ⚡ Темп отправки: {f'{rate:.2f} шт/с' if rate else 'ещё не отправляла'}\n\n"
             )
-        finally:
-            loop.close()
-
-    @bot.callback_query_handler(func=lambda call: call.data == "add_lot")
-    def add_new_lot(call: types.CallbackQuery):
-        bot.delete_message(call.message.chat.id, call.message.message_id)
 
         kb = InlineKeyboardMarkup()
         kb.add(InlineKeyboardButton("🔙 Вернуться в настройки", callback_data="to_setting"))
+        return text, kb
 
-        msg = bot.send_message(
-            call.message.chat.id,
-            "📦 Давай добавим новый лот!\n🔢 Введи <b>ID лота</b>, который хочешь добавить:",
-            parse_mode="HTML",
-            reply_markup=kb
-        )
+    @bot.callback_query_handler(func=lambda call: call.data == "add_lot")
+    def add_new_lot(call: types.CallbackQuery):
+        # Панель настроек сменилась другим экраном, фоновое обновление балансов его не перерисует
+        live_messages.forget(call.message.chat.id, call.message.message_id)
+        bot.delete_message(call.message.chat.id, call.message.message_id)
+        lot_wizard.start(call.message.chat.id)
 
-        bot.register_next_step_handler(msg, process_new_lot)
+    @bot.callback_query_handler(func=lambda call: call.data == "add_lot_cancel")
+    def add_lot_cancel(call: types.CallbackQuery):
+        bot.delete_message(call.message.chat.id, call.message.message_id)
+        lot_wizard.cancel(call.message.chat.id)
 
     @bot.callback_query_handler(func=lambda call: call.data.startswith("ed_lot_"))
     def edit_lot_callback(call: types.CallbackQuery):
@@ -1057,9 +2718,10 @@ GIFT NAME: <code>{ld['gift_name']}</code>
 
     @bot.callback_query_handler(func=lambda call: call.data == "active_lot")
     def lot_active(call: types.CallbackQuery):
-        state = toggle_subcat_status(c, 3064)
+        live_messages.forget(call.message.chat.id, call.message.message_id)
+        report = toggle_subcat_status(c, 3064)
         cfg = load_config()
-        if state is False:
+        if report["target"] is False:
             stat = "деактивированы"
             cfg['active_lots'] = False
         else:
@@ -1068,8 +2730,16 @@ GIFT NAME: <code>{ld['gift_name']}</code>
         save_config(cfg)
         kb = InlineKeyboardMarkup()
         kb.add(InlineKeyboardButton("🔙 Вернуться в настройки", callback_data="to_setting"))
+        text = (
+            f"✅ Лоты успешно <b>{stat}</b>! 🎉\n\n"
+            f"🔄 Изменено: {len(report['changed'])}\n"
+            f"⏸ Уже были в нужном состоянии: {len(report['skipped'])}"
+        )
+        if report["failed"]:
+            text = text.replace("✅", "⚠️", 1) + f"\n❌ Ошибок: {len(report['failed'])}\n"
+            text += "\n".join(f"• {lot_id}: {error}" for lot_id, error in list(report["failed"].items())[:10])
         bot.edit_message_text(
-            f"✅ Лоты успешно <b>{stat}</b>! 🎉",
+            text,
             call.message.chat.id,
             call.message.message_id,
             parse_mode='HTML',
@@ -1078,6 +2748,7 @@ GIFT NAME: <code>{ld['gift_name']}</code>
 
     @bot.callback_query_handler(func=lambda call: call.data == "lot_se")
     def lot_set(call: types.CallbackQuery):
+        live_messages.forget(call.message.chat.id, call.message.message_id)
         bot.edit_message_text("📂 Выбери лот:", call.message.chat.id, call.message.message_id, reply_markup=generate_lots_keyboard(0))
 
     @bot.callback_query_handler(func=lambda call: call.data.startswith("pr_page_") or call.data.startswith("ne_page_"))
@@ -1090,52 +2761,13 @@ GIFT NAME: <code>{ld['gift_name']}</code>
 
     @bot.callback_query_handler(func=lambda call: call.data == "to_setting")
     def to_settings(call: types.CallbackQuery):
-        cfg = load_config()
-        lmap = cfg.get("lot_mapping", {})
-        auto_refunds = cfg.get("auto_refunds", True)
-        active_lots = cfg.get("active_lots", True)
-
-        loop = asyncio.new_event_loop()
-        try:
-            stars = loop.run_until_complete(get_balance())
-        finally:
-            loop.close()
-
-        txt = f"""
-    <b>⚙️ Панель управления Auto Gifts v{VERSION}</b>
-👨‍💻 <b>Разработчик:</b> {CREDITS}
-
-📦 <b>Лотов в системе:</b> {len(lmap)}
-🌟 <b>Баланс звёзд (активная сессия):</b> {stars}
-📝 <b>Описание:</b> {DESCRIPTION}
-📡 <b>Активных сессий:</b> {sum(1 for s in session_manager.sessions if s['active'])}/{len(session_manager.sessions)}
-    """.strip()
-
-        kb = InlineKeyboardMarkup(row_width=2)
-        kb.add(
-            InlineKeyboardButton("🛠️ Управление лотами", callback_data="lot_se"),
-            InlineKeyboardButton("📥 Загрузить лоты", callback_data="upload_lots"),
-            InlineKeyboardButton(
-                f"{'🟢' if auto_refunds else '🔴'} Автовозвраты", callback_data="auto_refund"
-            ),
-            InlineKeyboardButton(
-                f"{'🟢' if active_lots else '🔴'} Лоты активны", callback_data="active_lot"
-            ),
-            InlineKeyboardButton("➕ Добавить лот", callback_data="add_lot"),
-            InlineKeyboardButton("📊 Статистика", callback_data="show_stat"),
-            InlineKeyboardButton("📡 Статус сессий", callback_data="show_sessions")  # New button
-        )
-
-        bot.edit_message_text(
-            txt,
-            call.message.chat.id,
-            call.message.message_id,
-            parse_mode='HTML',
-            reply_markup=kb
-        )
+        lot_wizard.cancel(call.message.chat.id, silent=True)
+        render = functools.partial(render_settings, f"<b>⚙️ Панель управления Auto Gifts v{VERSION}</b>", "➕ Добавить лот")
+        live_messages.show(call.message.chat.id, render, refresh_balances, call.message.message_id)
 
     @bot.callback_query_handler(func=lambda call: call.data == "show_stat")
     def show_orders(call: types.CallbackQuery):
+        live_messages.forget(call.message.chat.id, call.message.message_id)
         stats = get_statistics()
         kb = InlineKeyboardMarkup()
         kb.add(InlineKeyboardButton("🔙 Вернуться в настройки", callback_data="to_setting"))
@@ -1187,9 +2819,10 @@ GIFT NAME: <code>{ld['gift_name']}</code>
 
     @bot.callback_query_handler(func=lambda call: call.data == "upload_lots")
     def upload_lots_json(call: types.CallbackQuery):
+        live_messages.forget(call.message.chat.id, call.message.message_id)
         user_id = call.from_user.id
         waiting_for_lots_upload.add(user_id)
-        logger.info(f"{LOGGER_PREFIX} Added user {user_id} to waiting_for_lots_upload: {waiting_for_lots_upload}")
+        logger.info("%s Added user %s to waiting_for_lots_upload: %s", LOGGER_PREFIX, user_id, waiting_for_lots_upload)
 
         kb = InlineKeyboardMarkup()
         kb.add(InlineKeyboardButton("🔙 Вернуться в настройки", callback_data="to_setting"))
@@ -1204,6 +2837,7 @@ GIFT NAME: <code>{ld['gift_name']}</code>
 
     @bot.callback_query_handler(func=lambda call: call.data == "auto_refund")
     def auto_refund(call: types.CallbackQuery):
+        live_messages.forget(call.message.chat.id, call.message.message_id)
         cfg = load_config()
         if cfg['auto_refunds'] is True:
             cfg['auto_refunds'] = False
@@ -1226,73 +2860,73 @@ GIFT NAME: <code>{ld['gift_name']}</code>
     ])
 
 def message_hook(c: Cardinal, e: NewMessageEvent):
-    global queue
     if not RUNNING:
-        logger.debug(f"{LOGGER_PREFIX} Plugin not running, ignoring message from {e.message.author}")
+        logger.debug("%s Plugin not running, ignoring message from %s", LOGGER_PREFIX, e.message.author)
         return
-    tg = c.telegram
-    bot = tg.bot
     my_id = c.account.id
 
     if e.message.author_id == my_id:
-        logger.debug(f"{LOGGER_PREFIX} Ignoring message from self (ID: {my_id})")
+        logger.debug("%s Ignoring message from self (ID: %s)", LOGGER_PREFIX, my_id)
         return
 
     msg_text = e.message.text.strip()
     msg_author_id = e.message.author_id
     msg_chat_id = e.message.chat_id
 
-    logger.debug(f"{LOGGER_PREFIX} Received message from {e.message.author} (ID: {msg_author_id}): {msg_text}")
+    logger.debug("%s Received message from %s (ID: %s): %s", LOGGER_PREFIX, e.message.author, msg_author_id, msg_text)
 
-    if msg_author_id not in queue:
-        logger.debug(f"{LOGGER_PREFIX} User {msg_author_id} not found in queue")
+    # Сообщение может относиться к заказу, который сам ещё ждёт в очереди прогрева
+    if warmup.defer(message_hook, c, e):
+        logger.debug("%s Sessions are warming up, message from %s queued", LOGGER_PREFIX, msg_author_id)
         return
 
-    data = queue.get(msg_author_id)
+    data = order_store.find_conversation(msg_author_id, msg_chat_id)
     if not data:
-        logger.warning(f"{LOGGER_PREFIX} No data found for user {msg_author_id} in queue")
+        logger.debug("%s User %s has no pending orders", LOGGER_PREFIX, msg_author_id)
+        return
+
+    if data["step"] == "sending":
+        logger.debug("%s Order #%s is being delivered, ignoring message", LOGGER_PREFIX, data['order_id'])
         return
 
     if data["step"] == "await_username":
-        logger.debug(f"{LOGGER_PREFIX} Processing username for order #{data['order_id']}")
+        logger.debug("%s Processing username for order #%s", LOGGER_PREFIX, data['order_id'])
         username_match = re.match(r'^@(\w+)$', msg_text)
         if not username_match:
             logger.warning(f"{LOGGER_PREFIX} Invalid username format: {msg_text} for order #{data['order_id']}")
-            c.send_message(
+            send_funpay_message(
+                c,
                 msg_chat_id,
                 "🐒 Юзернейм не распознан!\nДолжен быть в формате @username.\nПопробуй ещё раз 👇"
             )
             return
         username = username_match.group(1)
         order_id = data['order_id']
-        logger.debug(f"{LOGGER_PREFIX} Username recognized: {username} for order #{order_id}")
+        logger.debug("%s Username recognized: %s for order #%s", LOGGER_PREFIX, username, order_id)
 
         try:
-            session = asyncio.run(session_manager.get_active_session(order_id))
+            session = runner.run(session_manager.get_active_session(order_id))
             if not session:
                 logger.error(f"{LOGGER_PREFIX} No active sessions for username check, order #{order_id}")
-                c.send_message(
+                send_funpay_message(
+                    c,
                     msg_chat_id,
                     "❌ Нет доступных сессий для обработки заказа. Свяжитесь с продавцом."
                 )
                 return
-            data["session_name"] = session["name"]
-            name = asyncio.run(check_username(c, msg_chat_id, username, order_id))
+            order_store.update(order_id, session_name=session["name"])
+            name = runner.run(check_username(c, msg_chat_id, username, order_id))
             if name is None:
-                logger.debug(f"{LOGGER_PREFIX} Failed to get username for {username}, order #{data['order_id']}")
+                logger.debug("%s Failed to get username for %s, order #%s", LOGGER_PREFIX, username, data['order_id'])
                 return
         except Exception as e:
             logger.error(f"{LOGGER_PREFIX} Error checking username {username} for order #{order_id}: {type(e).__name__}: {str(e)}")
-            c.send_message(
+            send_funpay_message(
+                c,
                 msg_chat_id,
                 f"❌ Ошибка при проверке юзернейма для заказа #{order_id}. Свяжитесь с продавцом.\nПодробности: {str(e)}"
             )
-            for user_id in get_authorized_users():
-                bot.send_message(
-                    user_id,
-                    f"❌ Ошибка при проверке юзернейма для заказа #{order_id}: {type(e).__name__}: {str(e)}",
-                    parse_mode='HTML'
-                )
+            notifier.notify(f"❌ Ошибка при проверке юзернейма для заказа #{order_id}: {type(e).__name__}: {str(e)}", key=f"username_error:{type(e).__name__}")
             return
 
         order_amount = data["order_amount"]
@@ -1310,49 +2944,50 @@ def message_hook(c: Cardinal, e: NewMessageEvent):
             f"✏️ Нужно изменить данные? Отправь -\n"
             f"💬 Если хотите отправить подарок с комментарием (до 200 символов) и не анонимно, напишите его."
         )
-        c.send_message(msg_chat_id, order_text)
-        data['name'] = name
-        data['username'] = username
-        data["step"] = "await_confirm"
-        logger.info(f"{LOGGER_PREFIX} Username processed: {username}, moving to confirmation for order #{order_id}")
+        send_funpay_message(c, msg_chat_id, order_text)
+        order_store.update(order_id, name=name, username=username, step="await_confirm")
+        logger.info("%s Username processed: %s, moving to confirmation for order #%s", LOGGER_PREFIX, username, order_id)
         return
 
     elif data["step"] == "await_confirm":
-        logger.debug(f"{LOGGER_PREFIX} Processing confirmation for order #{data['order_id']}: {msg_text}")
+        logger.debug("%s Processing confirmation for order #%s: %s", LOGGER_PREFIX, data['order_id'], msg_text)
         order_id = data["order_id"]
-        order_amount = data["order_amount"]
+        order_amount = fulfilment.remaining(data)
         amount = data["amount"]
         username = data['username']
         name = data['name']
-        order_time = data['order_time']
         gift_id = data['gift_id']
         gift_name = data['gift_name']
-        order_price = data['order_price']
-        order_profit = data['order_profit']
         session_name = data.get("session_name")
 
-        if msg_text == "-":
-            logger.debug(f"{LOGGER_PREFIX} User declined order #{order_id}, returning to username input")
-            c.send_message(
+        if msg_text == "-" and fulfilment.sent_count(order_id):
+            send_funpay_message(
+                c,
+                msg_chat_id,
+                f"❌ Часть подарков уже отправлена на @{username}, получателя изменить нельзя.\n✅ Отправьте + чтобы довыдать оставшиеся {order_amount} шт."
+            )
+            return
+        elif msg_text == "-":
+            logger.debug("%s User declined order #%s, returning to username input", LOGGER_PREFIX, order_id)
+            send_funpay_message(
+                c,
                 msg_chat_id,
                 "📍 Отправьте ещё раз ваш @username"
             )
-            data["step"] = "await_username"
-            data['comment'] = None
-            data['is_anonymous'] = True
+            order_store.update(order_id, step="await_username", comment=None, is_anonymous=True)
             return
         elif msg_text == "+":
-            logger.debug(f"{LOGGER_PREFIX} User confirmed order #{order_id}, proceeding to send gifts")
+            logger.debug("%s User confirmed order #%s, proceeding to send gifts", LOGGER_PREFIX, order_id)
         else:
             if len(msg_text) > 200:
-                c.send_message(
+                send_funpay_message(
+                    c,
                     msg_chat_id,
                     "❌ Комментарий слишком длинный (максимум 200 символов). Попробуйте снова или отправьте '+' для отправки."
                 )
                 logger.warning(f"{LOGGER_PREFIX} Comment too long for order #{order_id}: {len(msg_text)} characters")
                 return
-            data['comment'] = msg_text
-            data['is_anonymous'] = False
+            order_store.update(order_id, comment=msg_text, is_anonymous=False)
             name_display = name if name else "не указано"
             order_text = (
                 f"🔎 Подарок уже готов к выдаче - осталось проверить и подтвердить:\n\n"
@@ -1365,215 +3000,156 @@ def message_hook(c: Cardinal, e: NewMessageEvent):
                 f"✏️ Нужно изменить данные? Отправь - \n"
                 f"💬 Если хотите изменить комментарии - просто напишите его еще раз"
             )
-            c.send_message(msg_chat_id, order_text)
-            logger.info(f"{LOGGER_PREFIX} Comment updated: {msg_text}, waiting for final confirmation for order #{order_id}")
+            send_funpay_message(c, msg_chat_id, order_text)
+            logger.info("%s Comment updated: %s, waiting for final confirmation for order #%s", LOGGER_PREFIX, msg_text, order_id)
             return
         try:
             session = next((s for s in session_manager.sessions if s["name"] == session_name), None)
             if not session or not session["active"] or session["balance"] < order_amount * amount:
                 logger.warning(f"{LOGGER_PREFIX} Session {session_name} is invalid or insufficient for order #{order_id}")
-                session = asyncio.run(session_manager.get_active_session(order_id))
+                session = runner.run(session_manager.get_active_session(order_id, order_amount * amount))
+                if not session:
+                    session = runner.run(session_manager.get_active_session(order_id))
                 if not session:
                     logger.error(f"{LOGGER_PREFIX} No active sessions for order #{order_id}")
-                    c.send_message(
+                    send_funpay_message(
+                        c,
                         msg_chat_id,
                         "❌ Нет доступных сессий для обработки заказа. Свяжитесь с продавцом."
                     )
                     return
                 session_name = session["name"]
-                data["session_name"] = session_name
-            stars = session["balance"]
-            logger.debug(f"{LOGGER_PREFIX} Star balance: {stars}, required: {order_amount * amount} for order #{order_id}")
-            if order_amount * amount > stars:
-                logger.warning(f"{LOGGER_PREFIX} Insufficient stars for order #{order_id}. Required: {order_amount * amount}, available: {stars}")
+                order_store.update(order_id, session_name=session_name)
+            # Делить можно только целыми подарками, поэтому сумма балансов пула тут не показатель
+            covered = dispatcher.can_cover(amount, order_amount)
+            logger.debug("%s Sessions cover %s × %s stars for order #%s: %s", LOGGER_PREFIX, order_amount, amount, order_id, covered)
+            if not covered:
+                pool = sum(s["balance"] or 0 for s in session_manager.sessions if s["active"])
+                logger.warning(f"{LOGGER_PREFIX} Insufficient stars for order #{order_id}. Required: {order_amount} × {amount}, pool balance: {pool}")
                 cfg = load_config()
                 auto_refunds = cfg.get("auto_refunds", True)
-                if auto_refunds:
-                    c.account.refund(order_id)
-                    c.send_message(
+                sent = fulfilment.sent_count(order_id)
+                order_url = f"https://funpay.com/orders/{order_id}/"
+                if sent:
+                    # Часть подарков уже у получателя: полный возврат отдал бы их бесплатно, заказ остаётся открытым
+                    send_funpay_message(
+                        c,
+                        msg_chat_id,
+                        f"⚠️ Отправлено {sent} из {data['order_amount']} подарков, на оставшиеся {order_amount} шт. сейчас не хватает звёзд.\nПродавец довыдаст их или вернёт за них деньги. Напишите #help, если есть вопросы."
+                    )
+                    notifier.notify(
+                        f"⚠️ Требуется частичный возврат для заказа #{order_id}: отправлено {sent} из {data['order_amount']}, не хватает звёзд на {order_amount} шт. по {amount} ⭐️\n🔗 Заказ: {order_url}",
+                        key=f"partial_refund:{order_id}"
+                    )
+                    logger.warning(f"{LOGGER_PREFIX} Order #{order_id} left open after {sent}/{data['order_amount']} gifts, partial refund needed")
+                elif auto_refunds:
+                    with metrics.timer("refund", gift=gift_id):
+                        c.account.refund(order_id)
+                    send_funpay_message(
+                        c,
                         msg_chat_id,
                         "❌ Баланса не хватило для оплаты, поэтому был осуществлён возврат средств. Приносим свои искренние извинения."
                     )
-                    logger.info(f"{LOGGER_PREFIX} Automatic refund for order #{order_id}")
+                    logger.info("%s Automatic refund for order #%s", LOGGER_PREFIX, order_id)
                 else:
-                    c.send_message(
+                    send_funpay_message(
+                        c,
                         msg_chat_id,
                         "❌ Баланса не хватило для оплаты, возврат средств требует ручного подтверждения. Напишите #help чтобы позвать продавца."
                     )
-                    order_url = f"https://funpay.com/orders/{order_id}/"
-                    for user_id in get_authorized_users():
-                        bot.send_message(
-                            user_id,
-                            f"⚠️ Требуется ручной возврат средств для заказа #{order_id}\n🔗 Перейдите по ссылке, чтобы вернуть деньги: {order_url}",
-                            parse_mode='HTML'
-                        )
-                queue.pop(msg_author_id, None)
-                state = is_subcat_active(c, 3064)
-                if state is False:
-                    logger.debug(f"{LOGGER_PREFIX} Lots already deactivated for order #{order_id}")
+                    notifier.notify(f"⚠️ Требуется ручной возврат средств для заказа #{order_id}\n🔗 Перейдите по ссылке, чтобы вернуть деньги: {order_url}")
+                if not sent:
+                    order_store.remove(order_id)
+                    fulfilment.close(order_id)
+                if not is_subcat_active(c, 3064):
+                    logger.debug("%s Lots already deactivated for order #%s", LOGGER_PREFIX, order_id)
                     return
-                status = toggle_subcat_status(c, 3064)
-                cfg['active_lots'] = status
+                report = set_subcat_active(c, 3064, False)
+                cfg['active_lots'] = False
                 save_config(cfg)
-                for user_id in get_authorized_users():
-                    bot.send_message(
-                        user_id,
-                        "✅ Звёзды закончились, лоты успешно деактивированы",
-                        parse_mode='HTML'
-                    )
-                logger.info(f"{LOGGER_PREFIX} Lots deactivated for order #{order_id}")
+                if report["failed"]:
+                    notice = f"⚠️ Звёзды закончились, деактивировано лотов: {len(report['changed'])}, не удалось: {len(report['failed'])}"
+                else:
+                    notice = "✅ Звёзды закончились, лоты успешно деактивированы"
+                notifier.notify(notice, key="lots_deactivated")
+                logger.info("%s Lots deactivated for order #%s", LOGGER_PREFIX, order_id)
                 return
         except Exception as e:
             logger.error(f"{LOGGER_PREFIX} Error getting balance for order #{order_id}: {type(e).__name__}: {str(e)}")
-            c.send_message(
+            send_funpay_message(
+                c,
                 msg_chat_id,
                 f"❌ Ошибка при проверке баланса для заказа #{order_id}. Свяжитесь с продавцом.\nПодробности: {str(e)}"
             )
-            for user_id in get_authorized_users():
-                bot.send_message(
-                    user_id,
-                    f"❌ Ошибка при проверке баланса для заказа #{order_id}: {type(e).__name__}: {str(e)}",
-                    parse_mode='HTML'
-                )
-            data["step"] = "await_username"
-            c.send_message(
+            notifier.notify(f"❌ Ошибка при проверке баланса для заказа #{order_id}: {type(e).__name__}: {str(e)}", key=f"balance_error:{type(e).__name__}")
+            order_store.update(order_id, step="await_username")
+            send_funpay_message(
+                c,
                 msg_chat_id,
                 "📍 Отправьте ещё раз ваш @username"
             )
             return
 
-        try:
-            result = asyncio.run(buy_gifts(c, msg_chat_id, username, gift_id, order_amount, order_id, bot, data['comment'], data['is_anonymous']))
-            logger.debug(f"{LOGGER_PREFIX} Gift sending result for order #{order_id}: {result}")
-            if not result:
-                logger.warning(f"{LOGGER_PREFIX} Gift sending failed for order #{order_id}, returning to username input")
-                data["step"] = "await_username"
-                c.send_message(
-                    msg_chat_id,
-                    "📍 Отправьте ещё раз ваш @username"
-                )
-                return
-            order_url = f"https://funpay.com/orders/{order_id}/"
-            success_text = (
-                f"✅ Готово! Подарки успешно отправлены {'в приватном режиме' if data['is_anonymous'] else 'открыто'} 🎉\n"
-                f"💬 Не забудь подтвердить заказ и оставить отзыв — это важно!\n\n"
-                f"🔗 Ссылка для подтверждения:\n{order_url}"
-            )
-            c.send_message(msg_chat_id, success_text)
-            logger.info(f"{LOGGER_PREFIX} Order #{order_id} successfully completed")
-            current_time = datetime.now().strftime("%H:%M:%S")
-            text = (
-                f"🎉 Заказ <a href='https://funpay.com/orders/{order_id}/'>{order_id}</a> выполнен!\n\n"
-                f"👤 <b>Username:</b> @{username}\n"
-                f"📝 <b>Ник в системе:</b> {name if name else 'не указано'}\n"
-                f"🎁 <b>Подарков:</b> {order_amount} × {amount} ⭐️ ({gift_name})\n"
-                f"💬 <b>Комментарий:</b> {data['comment'] if data['comment'] else 'Рандомный (анонимно)'}\n"
-                f"💸 <b>Оплачено:</b> {order_price} ₽\n"
-                f"💰 <b>Чистый профит:</b> {order_profit} ₽\n\n"
-                f"⏳ <b>Добавлен в очередь:</b> <code>{order_time}</code>\n"
-                f"✅ <b>Завершён:</b> <code>{current_time}</code>\n"
-                f"📡 <b>Сессия:</b> {session_name}"
-            )
-            for user_id in get_authorized_users():
-                bot.send_message(
-                    user_id,
-                    text,
-                    parse_mode='HTML'
-                )
-            queue.pop(msg_author_id, None)
-            logger.debug(f"{LOGGER_PREFIX} Order #{order_id} removed from queue")
-            return
-        except StargiftUsageLimited as e:
-            logger.error(f"{LOGGER_PREFIX} Error: Gift sold out for order #{order_id}: {str(e)}")
-            for user_id in get_authorized_users():
-                bot.send_message(
-                    user_id,
-                    f"❌ Подарок распродан для заказа #{order_id}: {str(e)}",
-                    parse_mode='HTML'
-                )
-            c.send_message(
-                msg_chat_id,
-                "❌ Этот подарок распродан! Напишите #help для связи с продавцом."
-            )
-            queue.pop(msg_author_id, None)
-            return
-        except Exception as e:
-            logger.error(f"{LOGGER_PREFIX} Error processing order #{order_id}: {type(e).__name__}: {str(e)}")
-            for user_id in get_authorized_users():
-                bot.send_message(
-                    user_id,
-                    f"❌ Ошибка при обработке заказа #{order_id}: {type(e).__name__}: {str(e)}",
-                    parse_mode='HTML'
-                )
-            c.send_message(
-                msg_chat_id,
-                f"❌ Произошла ошибка при обработке заказа #{order_id}. Свяжитесь с продавцом.\nПодробности: {str(e)}"
-            )
-            data["step"] = "await_username"
-            c.send_message(
-                msg_chat_id,
-                "📍 Отправьте ещё раз ваш @username"
-            )
-            return
+        order_store.update(order_id, step="sending")
+        dispatcher.submit(c, data)
+        logger.info("%s Order #%s confirmed and handed to the dispatcher", LOGGER_PREFIX, order_id)
+        return
 
 def order_hook(c: Cardinal, e: NewOrderEvent):
     if not RUNNING:
-        logger.debug(f"{LOGGER_PREFIX} Plugin not running, skipping order #{e.order.id}")
+        logger.debug("%s Plugin not running, skipping order #%s", LOGGER_PREFIX, e.order.id)
+        return
+    if warmup.defer(order_hook, c, e):
+        logger.info("%s Sessions are warming up, order #%s queued", LOGGER_PREFIX, e.order.id)
         return
     order = e.order
     order_description = order.description
-    logger.debug(f"{LOGGER_PREFIX} Processing order #{order.id} with description: {order_description}")
+    logger.debug("%s Processing order #%s with description: %s", LOGGER_PREFIX, order.id, order_description)
     gift_id, gift_name = get_tg_id_by_description(order_description)
     if gift_id is None or gift_name is None:
-        logger.info(f"{LOGGER_PREFIX} Lot not found for description: {order_description}. Skipping order #{order.id}.")
+        logger.info("%s Lot not found for description: %s. Skipping order #%s.", LOGGER_PREFIX, order_description, order.id)
         return
-    loop = asyncio.new_event_loop()
     try:
-        amount = loop.run_until_complete(get_amount(gift_id))
+        amount = runner.run(get_amount(gift_id))
         if amount is None:
             logger.error(f"{LOGGER_PREFIX} Failed to get gift price for gift_id: {gift_id}, order #{order.id}")
-            c.send_message(order.chat_id, f"❌ Ошибка при обработке заказа #{order.id}: не удалось определить стоимость подарка. Свяжитесь с продавцом.")
-            for user_id in get_authorized_users():
-                c.telegram.bot.send_message(
-                    user_id,
-                    f"❌ Ошибка при получении стоимости подарка для заказа #{order.id}: gift_id {gift_id}",
-                    parse_mode='HTML'
-                )
+            send_funpay_message(c, order.chat_id, f"❌ Ошибка при обработке заказа #{order.id}: не удалось определить стоимость подарка. Свяжитесь с продавцом.")
+            notifier.notify(f"❌ Ошибка при получении стоимости подарка для заказа #{order.id}: gift_id {gift_id}", key=f"gift_price:{gift_id}")
             return
     except Exception as e:
         logger.error(f"{LOGGER_PREFIX} Error getting gift price for order #{order.id}: {type(e).__name__}: {str(e)}")
-        c.send_message(order.chat_id, f"❌ Ошибка при обработке заказа #{order.id}. Свяжитесь с продавцом.\nПодробности: {str(e)}")
-        for user_id in get_authorized_users():
-            c.telegram.bot.send_message(
-                user_id,
-                f"❌ Ошибка при получении стоимости подарка для заказа #{order.id}: {type(e).__name__}: {str(e)}",
-                parse_mode='HTML'
-            )
+        send_funpay_message(c, order.chat_id, f"❌ Ошибка при обработке заказа #{order.id}. Свяжитесь с продавцом.\nПодробности: {str(e)}")
+        notifier.notify(f"❌ Ошибка при получении стоимости подарка для заказа #{order.id}: {type(e).__name__}: {str(e)}", key=f"gift_price_error:{type(e).__name__}")
+        return
+    if gift_catalog.is_sold_out(gift_id, int(order.amount)):
+        logger.warning(f"{LOGGER_PREFIX} Gift {gift_id} is sold out, order #{order.id} not accepted")
+        send_funpay_message(c, order.chat_id, "❌ Этот подарок распродан! Напишите #help для связи с продавцом.")
+        notifier.notify(f"❌ Подарок {gift_name} распродан, заказ #{order.id} не принят в работу", key=f"sold_out:{gift_id}")
         return
-    finally:
-        loop.close()
     order_id = order.id
     order_price = order.price
     buyer_id = int(order.buyer_id)
     order_amount = int(order.amount)
-    order_fulldata = c.account.get_order(order_id)
+    with metrics.timer("get_order", gift=gift_id):
+        order_fulldata = c.account.get_order(order_id)
     chat_id = order_fulldata.chat_id
     star_cost = amount * 1.16 * 1.06  # 1.16 руб. за звезду + 6% комиссии
     order_profit = round(order_price - order_amount * star_cost, 1)
     save_order_info(order_id, order_price, order_description, order_profit)
 
-    logger.info(f"{LOGGER_PREFIX} 🛍 Order #{order_id} accepted and paid — {order_amount} gifts ready to send! ({gift_name})")
+    logger.info("%s 🛍 Order #%s accepted and paid — %s gifts ready to send! (%s)", LOGGER_PREFIX, order_id, order_amount, gift_name)
     start_text = (
         f"🎉 Заказ #{order_id} принят!\n"
         f"{order_amount} подарков ({gift_name}) готово к выдаче.\n\n"
         f"Отправьте свой Telegram юзернейм (например: @username), чтобы я знал, куда всё отправить 🍀\n"
     )
 
-    logger.debug(f"{LOGGER_PREFIX} #{order_id} | gift_id: {gift_id}, gift_name: {gift_name}, amount: {amount}")
-    c.send_message(chat_id, start_text)
+    logger.debug("%s #%s | gift_id: %s, gift_name: %s, amount: %s", LOGGER_PREFIX, order_id, gift_id, gift_name, amount)
+    send_funpay_message(c, chat_id, start_text)
     order_time = datetime.now().strftime("%H:%M:%S")
-    queue[buyer_id] = {
+    order_store.add({
         "order_id": order_id,
+        "buyer_id": buyer_id,
         "chat_id": chat_id,
         "step": "await_username",
         "amount": amount,
@@ -1585,8 +3161,9 @@ def order_hook(c: Cardinal, e: NewOrderEvent):
         "order_profit": order_profit,
         "comment": None,
         "is_anonymous": True
-    }
-    logger.debug(f"{LOGGER_PREFIX} Order #{order_id} added to queue: {queue}")
+    })
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("%s Order #%s added to pending orders: %s", LOGGER_PREFIX, order_id, order_store.get(order_id))
 
 BIND_TO_PRE_INIT = [init_commands]
 BIND_TO_NEW_MESSAGE = [message_hook]
@@ -0,0 +1,508 @@
+"""Offline end-to-end benchmark of the order pipeline.
+
+Runs order_hook -> message_hook (username, then "+") -> delivery against
+in-process stand-ins for Cardinal, FunPay, telebot and pyrogram.Client, and
+reports throughput, time-to-delivery percentiles and Telegram calls per order.
+
+    python benchmarks/bench_pipeline.py --sessions 4 --buyers 50 --gifts 3 --send-rate 20
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import types
+from collections import Counter
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+GIFT_ID = 5170250947678437525
+GIFT_PRICE = 15
+ADMIN_ID = 1
+SELLER_ID = 2
+LOT_DESCRIPTION = "⚡️ АВТОВЫДАЧА ⚡️ | 🔮🎁 ПОДАРОК 🎁🔮 ПОДАРОК НА АККАУНТ 🔮 ПО USERNAME 🔮 |"
+
+
+class Latency:
+    """Random delay and failure source shared by the fakes"""
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.lock = threading.Lock()
+
+    def delay(self, base: float) -> float:
+        with self.lock:
+            return max(base + self.rng.uniform(-self.args.jitter, self.args.jitter) * base, 0)
+
+    def chance(self, rate: float) -> bool:
+        if rate <= 0:
+            return False
+        with self.lock:
+            return self.rng.random() < rate
+
+
+class Calls:
+    """Thread-safe call counters per fake API"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = Counter()
+
+    def hit(self, name: str):
+        with self.lock:
+            self.counts[name] += 1
+
+
+def install_fakes(args, latency: Latency, calls: Calls):
+    """Register stand-in modules for the plugin's third-party imports"""
+
+    # --- pyrogram ---
+    class FloodWait(Exception):
+        def __init__(self, value=1):
+            super().__init__(f"FLOOD_WAIT_{value}")
+            self.value = value
+
+    class UsernameNotOccupied(Exception):
+        pass
+
+    class UsernameInvalid(Exception):
+        pass
+
+    class StargiftUsageLimited(Exception):
+        pass
+
+    class ChatType:
+        PRIVATE = "private"
+        CHANNEL = "channel"
+        GROUP = "group"
+
+    class Client:
+        def __init__(self, name, workdir=None, **kwargs):
+            self.name = name
+            self.is_connected = False
+
+        async def _call(self, name, base):
+            calls.hit(f"tg.{name}")
+            await asyncio.sleep(latency.delay(base))
+
+        async def start(self):
+            # Как в pyrogram: соединение открывается сразу, долгая часть (авторизация, initialize) идёт после
+            self.is_connected = True
+            await self._call("start", args.tg_connect_latency)
+            return self
+
+        async def stop(self):
+            calls.hit("tg.stop")
+            self.is_connected = False
+
+        async def get_me(self):
+            await self._call("get_me", args.tg_latency)
+            return types.SimpleNamespace(id=hash(self.name) & 0xFFFF)
+
+        async def get_stars_balance(self):
+            await self._call("get_stars_balance", args.tg_latency)
+            return args.balance
+
+        async def get_available_gifts(self):
+            await self._call("get_available_gifts", args.tg_latency)
+            return [types.SimpleNamespace(
+                id=GIFT_ID, price=GIFT_PRICE, is_limited=False,
+                available_amount=None, total_amount=None, is_sold_out=False
+            )]
+
+        async def get_chat(self, chat_id):
+            await self._call("get_chat", args.tg_latency)
+            return types.SimpleNamespace(id=abs(hash(chat_id)) & 0xFFFFFF, type=ChatType.PRIVATE, first_name=f"User {chat_id}")
+
+        async def send_gift(self, chat_id, gift_id, is_private=True, text=None):
+            await self._call("send_gift", args.tg_send_latency)
+            if latency.chance(args.flood_rate):
+                raise FloodWait(args.flood_wait)
+            if latency.chance(args.fail_rate):
+                raise RuntimeError("simulated send_gift failure")
+            return True
+
+    pyrogram = types.ModuleType("pyrogram")
+    pyrogram.Client = Client
+    errors = types.ModuleType("pyrogram.errors")
+    errors.FloodWait = FloodWait
+    errors.UsernameNotOccupied = UsernameNotOccupied
+    errors.UsernameInvalid = UsernameInvalid
+    exceptions = types.ModuleType("pyrogram.errors.exceptions")
+    bad_request = types.ModuleType("pyrogram.errors.exceptions.bad_request_400")
+    bad_request.StargiftUsageLimited = StargiftUsageLimited
+    enums = types.ModuleType("pyrogram.enums")
+    enums.ChatType = ChatType
+    pyrogram.errors = errors
+    pyrogram.enums = enums
+    errors.exceptions = exceptions
+    exceptions.bad_request_400 = bad_request
+
+    # --- telebot ---
+    class InlineKeyboardMarkup:
+        def __init__(self, row_width=3):
+            self.keyboard = []
+
+        def add(self, *buttons):
+            self.keyboard.append(buttons)
+            return self
+
+        def row(self, *buttons):
+            return self.add(*buttons)
+
+    class InlineKeyboardButton:
+        def __init__(self, text, callback_data=None, **kwargs):
+            self.text = text
+            self.callback_data = callback_data
+
+    telebot = types.ModuleType("telebot")
+    telebot_types = types.ModuleType("telebot.types")
+    telebot_types.InlineKeyboardMarkup = InlineKeyboardMarkup
+    telebot_types.InlineKeyboardButton = InlineKeyboardButton
+    telebot_types.Message = type("Message", (), {})
+    telebot_types.CallbackQuery = type("CallbackQuery", (), {})
+    telebot.types = telebot_types
+
+    # --- Cardinal / FunPayAPI ---
+    cardinal = types.ModuleType("cardinal")
+    cardinal.Cardinal = type("Cardinal", (), {})
+    funpay = types.ModuleType("FunPayAPI")
+    updater = types.ModuleType("FunPayAPI.updater")
+    events = types.ModuleType("FunPayAPI.updater.events")
+    events.NewOrderEvent = type("NewOrderEvent", (), {})
+    events.NewMessageEvent = type("NewMessageEvent", (), {})
+    funpay.updater = updater
+    updater.events = events
+
+    sys.modules.update({
+        "pyrogram": pyrogram,
+        "pyrogram.errors": errors,
+        "pyrogram.errors.exceptions": exceptions,
+        "pyrogram.errors.exceptions.bad_request_400": bad_request,
+        "pyrogram.enums": enums,
+        "telebot": telebot,
+        "telebot.types": telebot_types,
+        "cardinal": cardinal,
+        "FunPayAPI": funpay,
+        "FunPayAPI.updater": updater,
+        "FunPayAPI.updater.events": events,
+    })
+
+
+class FakeBot:
+    """telebot.TeleBot stand-in: handlers are accepted and ignored, sends are counted"""
+    def __init__(self, latency: Latency, calls: Calls, args):
+        self.latency = latency
+        self.calls = calls
+        self.args = args
+
+    def send_message(self, chat_id, text, **kwargs):
+        self.calls.hit("bot.send_message")
+        time.sleep(self.latency.delay(self.args.bot_latency))
+        return types.SimpleNamespace(chat=types.SimpleNamespace(id=chat_id), message_id=1)
+
+    def edit_message_text(self, *args, **kwargs):
+        self.calls.hit("bot.edit_message_text")
+
+    def delete_message(self, *args, **kwargs):
+        self.calls.hit("bot.delete_message")
+
+    def message_handler(self, **kwargs):
+        return lambda func: func
+
+    def callback_query_handler(self, **kwargs):
+        return lambda func: func
+
+    def register_next_step_handler(self, *args, **kwargs):
+        pass
+
+    def clear_step_handler_by_chat_id(self, *args, **kwargs):
+        pass
+
+
+class FakeAccount:
+    def __init__(self, latency: Latency, calls: Calls, args):
+        self.id = SELLER_ID
+        self.latency = latency
+        self.calls = calls
+        self.args = args
+
+    def get_order(self, order_id):
+        self.calls.hit("fp.get_order")
+        time.sleep(self.latency.delay(self.args.fp_latency))
+        return types.SimpleNamespace(chat_id=f"chat-{order_id}")
+
+    def refund(self, order_id):
+        self.calls.hit("fp.refund")
+
+    def get_my_subcategory_lots(self, subcat_id):
+        self.calls.hit("fp.get_my_subcategory_lots")
+        return []
+
+
+class FakeCardinal:
+    """Cardinal stand-in: buyer-facing messages wake up the simulated buyer of that chat"""
+    def __init__(self, latency: Latency, calls: Calls, args):
+        self.latency = latency
+        self.calls = calls
+        self.args = args
+        self.account = FakeAccount(latency, calls, args)
+        self.telegram = types.SimpleNamespace(bot=FakeBot(latency, calls, args), msg_handler=lambda *a, **kw: None)
+        self.lock = threading.Lock()
+        self.inboxes = {}
+
+    def add_telegram_commands(self, *args, **kwargs):
+        pass
+
+    def inbox(self, chat_id):
+        with self.lock:
+            return self.inboxes.setdefault(chat_id, Inbox())
+
+    def send_message(self, chat_id, text, *args, **kwargs):
+        self.calls.hit("fp.send_message")
+        time.sleep(self.latency.delay(self.args.fp_latency))
+        self.inbox(chat_id).put(text)
+        return True
+
+
+class Inbox:
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.messages = []
+
+    def put(self, text):
+        with self.cond:
+            self.messages.append(text)
+            self.cond.notify_all()
+
+    def wait_for(self, markers, start: int, timeout: float):
+        """Index and text of the first message after start containing one of markers"""
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while True:
+                for idx in range(start, len(self.messages)):
+                    if any(marker in self.messages[idx] for marker in markers):
+                        return idx, self.messages[idx]
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None, None
+                self.cond.wait(remaining)
+
+
+DONE_MARKER = "✅ Готово!"
+RETRY_USERNAME_MARKER = "📍 Отправьте ещё раз ваш @username"
+RETRY_CONFIRM_MARKER = "Отправьте + чтобы"
+CONFIRM_MARKERS = ("Проверим заказ", "❌", "🐒")
+FAIL_MARKERS = ("Нет доступных сессий", "Нет активных сессий", "Баланса не хватило")
+
+
+def run_buyer(ag, c: FakeCardinal, idx: int, args, results: list):
+    order_id = f"B{idx:06d}"
+    buyer_id = 100000 + idx
+    chat_id = f"chat-{order_id}"
+    username = f"buyer{idx:05d}"
+    inbox = c.inbox(chat_id)
+
+    def say(text):
+        message = types.SimpleNamespace(author=username, author_id=buyer_id, chat_id=chat_id, text=text)
+        ag.message_hook(c, types.SimpleNamespace(message=message))
+
+    def fail(reason):
+        results.append({"order_id": order_id, "ok": False, "reason": reason.splitlines()[0][:60], "retries": retries})
+
+    def send_username():
+        """Send the username and wait for the confirmation prompt; returns the reply text"""
+        seen = len(inbox.messages)
+        say(f"@{username}")
+        idx_, text = inbox.wait_for(CONFIRM_MARKERS, seen, args.timeout)
+        return idx_, text
+
+    retries = 0
+    started = time.monotonic()
+    order = types.SimpleNamespace(
+        id=order_id, description=LOT_DESCRIPTION, price=100.0,
+        buyer_id=buyer_id, amount=args.gifts, chat_id=chat_id
+    )
+    ag.order_hook(c, types.SimpleNamespace(order=order))
+    while True:
+        idx_, text = send_username()
+        if text is None:
+            fail("timeout")
+            return
+        if "Проверим заказ" not in text:
+            fail(text)
+            return
+        seen = idx_ + 1
+        say("+")
+        while True:
+            idx_, text = inbox.wait_for((DONE_MARKER, RETRY_USERNAME_MARKER, RETRY_CONFIRM_MARKER) + FAIL_MARKERS, seen, args.timeout)
+            if text is None:
+                fail("timeout")
+                return
+            seen = idx_ + 1
+            if DONE_MARKER in text:
+                results.append({"order_id": order_id, "ok": True, "latency": time.monotonic() - started, "retries": retries})
+                return
+            if any(marker in text for marker in FAIL_MARKERS) or retries >= args.max_retries:
+                fail(text)
+                return
+            retries += 1
+            if RETRY_USERNAME_MARKER in text:
+                break
+            say("+")
+
+
+def percentile(values, pct):
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * pct / 100
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+def prepare_workdir(args) -> str:
+    workdir = tempfile.mkdtemp(prefix="auto_gifts_bench_")
+    sessions = os.path.join(workdir, "sessions")
+    cache = os.path.join(workdir, "storage", "cache")
+    os.makedirs(sessions)
+    os.makedirs(cache)
+    for idx in range(args.sessions):
+        open(os.path.join(sessions, f"stars_{idx + 1}.session"), "w").close()
+    config = {
+        "lot_mapping": {"lot_1": {"name": LOT_DESCRIPTION, "gift_id": GIFT_ID, "gift_name": "Bench"}},
+        "auto_refunds": False,
+        "active_lots": True,
+        "split_orders": not args.no_split,
+        # Уведомления админу не на пути доставки; без ограничения темпа очередь успевает разойтись до отчёта
+        "notify_rate": 1000.0,
+    }
+    if args.send_rate:
+        config.update(send_rate=args.send_rate, send_rate_max=max(args.send_rate, 5.0), send_burst=args.send_burst)
+    with open(os.path.join(cache, "gift_lots.json"), "w", encoding="utf-8") as f:
+        json.dump(config, f, ensure_ascii=False)
+    with open(os.path.join(cache, "tg_authorized_users.json"), "w", encoding="utf-8") as f:
+        json.dump({str(ADMIN_ID): {}}, f)
+    os.environ["AUTO_GIFTS_SESSIONS_PATH"] = sessions
+    return workdir
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест конвейера заказов Auto Gifts на фейковых Cardinal/telebot/pyrogram")
+    parser.add_argument("--sessions", type=int, default=4, help="число Telegram-сессий")
+    parser.add_argument("--buyers", type=int, default=20, help="число покупателей (по одному заказу на каждого)")
+    parser.add_argument("--concurrency", type=int, default=10, help="сколько покупателей действуют одновременно")
+    parser.add_argument("--gifts", type=int, default=2, help="подарков в заказе")
+    parser.add_argument("--balance", type=int, default=100000, help="баланс звёзд каждой сессии")
+    parser.add_argument("--tg-latency", type=float, default=0.05, help="задержка вызовов pyrogram, сек.")
+    parser.add_argument("--tg-send-latency", type=float, default=0.1, help="задержка send_gift, сек.")
+    parser.add_argument("--tg-connect-latency", type=float, default=0.3, help="задержка подключения клиента, сек.")
+    parser.add_argument("--bot-latency", type=float, default=0.03, help="задержка telebot send_message, сек.")
+    parser.add_argument("--fp-latency", type=float, default=0.02, help="задержка вызовов FunPay, сек.")
+    parser.add_argument("--jitter", type=float, default=0.2, help="разброс задержек, доля от базовой")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="вероятность ошибки send_gift")
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="вероятность FloodWait на send_gift")
+    parser.add_argument("--flood-wait", type=int, default=1, help="длительность FloodWait, сек.")
+    parser.add_argument("--send-rate", type=float, default=None, help="send_rate сессии, шт/с (по умолчанию из DEFAULT_SETTINGS)")
+    parser.add_argument("--send-burst", type=int, default=1, help="send_burst при заданном --send-rate")
+    parser.add_argument("--no-split", action="store_true", help="не делить заказы между сессиями")
+    parser.add_argument("--max-retries", type=int, default=3, help="сколько раз покупатель повторяет заказ после ошибки")
+    parser.add_argument("--timeout", type=float, default=60, help="сколько покупатель ждёт ответа, сек.")
+    parser.add_argument("--seed", type=int, default=1, help="seed генератора задержек и ошибок")
+    parser.add_argument("--json", action="store_true", help="вывести результат одной JSON-строкой")
+    parser.add_argument("--keep-workdir", action="store_true", help="не удалять временную папку с логами и storage")
+    args = parser.parse_args()
+
+    latency = Latency(args)
+    calls = Calls()
+    workdir = prepare_workdir(args)
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    install_fakes(args, latency, calls)
+    sys.path.insert(0, REPO_ROOT)
+    try:
+        import_started = time.monotonic()
+        import auto_gifts as ag
+        import_time = time.monotonic() - import_started
+
+        c = FakeCardinal(latency, calls, args)
+        warmup_started = time.monotonic()
+        ag.init_commands(c)
+        ag.warmup.ready.wait(args.timeout)
+        warmup_time = time.monotonic() - warmup_started
+        warmup_calls = Counter(calls.counts)
+
+        results = []
+        started = time.monotonic()
+        semaphore = threading.Semaphore(args.concurrency)
+
+        def buyer(idx):
+            with semaphore:
+                run_buyer(ag, c, idx, args, results)
+
+        threads = [threading.Thread(target=buyer, args=(idx,), daemon=True) for idx in range(args.buyers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - started
+        # Отчёты о заказах уходят админу из очереди notifier: ждём её, иначе bot.send_message недосчитается
+        ag.notifier.stop(args.timeout)
+        ag.shutdown()
+    finally:
+        os.chdir(cwd)
+        if not args.keep_workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    run_calls = Counter(calls.counts)
+    run_calls.subtract(warmup_calls)
+    delivered = [r for r in results if r["ok"]]
+    latencies = [r["latency"] for r in delivered]
+    orders = max(len(results), 1)
+    report = {
+        "sessions": args.sessions,
+        "buyers": args.buyers,
+        "concurrency": args.concurrency,
+        "gifts_per_order": args.gifts,
+        "import_s": round(import_time, 3),
+        "warmup_s": round(warmup_time, 3),
+        "elapsed_s": round(elapsed, 3),
+        "delivered": len(delivered),
+        "failed": len(results) - len(delivered),
+        "retries": sum(r["retries"] for r in results),
+        "orders_per_s": round(len(delivered) / elapsed, 3) if elapsed else None,
+        "p50_s": round(percentile(latencies, 50), 3),
+        "p95_s": round(percentile(latencies, 95), 3),
+        "p99_s": round(percentile(latencies, 99), 3),
+        "tg_calls_per_order": round(sum(v for k, v in run_calls.items() if k.startswith("tg.")) / orders, 2),
+        "bot_calls_per_order": round(sum(v for k, v in run_calls.items() if k.startswith("bot.")) / orders, 2),
+        "fp_calls_per_order": round(sum(v for k, v in run_calls.items() if k.startswith("fp.")) / orders, 2),
+        "calls": {k: v for k, v in sorted(run_calls.items()) if v},
+        "failures": Counter(r["reason"] for r in results if not r["ok"]),
+    }
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False))
+        return
+    print(f"Сессий: {args.sessions}, покупателей: {args.buyers} (одновременно {args.concurrency}), подарков в заказе: {args.gifts}")
+    print(f"Импорт плагина: {report['import_s']} с, прогрев сессий: {report['warmup_s']} с")
+    print(f"Доставлено: {report['delivered']}/{len(results)} за {report['elapsed_s']} с, повторов: {report['retries']}")
+    print(f"Пропускная способность: {report['orders_per_s']} заказов/с")
+    print(f"Время до доставки: p50 {report['p50_s']} с, p95 {report['p95_s']} с, p99 {report['p99_s']} с")
+    print(
+        f"Вызовов на заказ: Telegram {report['tg_calls_per_order']}, "
+        f"бот {report['bot_calls_per_order']}, FunPay {report['fp_calls_per_order']}"
+    )
+    for name, count in report["calls"].items():
+        print(f"  {name}: {count}")
+    for reason, count in report["failures"].items():
+        print(f"  ошибка ×{count}: {reason}")
+
+
+if __name__ == "__main__":
+    main()